@@ -0,0 +1,46 @@
+"""
+ingestion benchmark, the same synthetic export as an xlsx workbook (openpyxl) and as a zip of csv sheets
+
+usage: python benchmarks/csv_ingestion.py [-o orders] [-n runs]
+"""
+
+import os, sys
+import shutil
+import tempfile
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sample_export import create_sample_export, create_sample_csv_bundle
+from supplier_reports.gen_reports import load_source_tables
+
+
+def time_load(file_path, runs):
+    timings = []
+    for x in range(runs):
+        start = time.time()
+        orders, products = load_source_tables(file_path)
+        timings.append(time.time() - start)
+    return sorted(timings)[len(timings) // 2], len(orders)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-o", "--orders", dest="orders", type="int", default=5000, help="orders in the sample export")
+    parser.add_option("-n", "--runs", dest="runs", type="int", default=3, help="loads per format")
+    options, args = parser.parse_args()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        sources = [("xlsx", create_sample_export(os.path.join(tmp_dir, "export.xlsx"), orders=options.orders)),
+                   ("csv zip", create_sample_csv_bundle(os.path.join(tmp_dir, "export.zip"), orders=options.orders))]
+        for name, file_path in sources:
+            elapsed, rows = time_load(file_path, options.runs)
+            print("{:<8} {:>8} rows  {:>9} bytes  median {:.3f}s over {} runs".format(
+                name, rows, os.path.getsize(file_path), elapsed, options.runs))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+cold start import benchmark for the CLI
+
+compares importing supplier_reports (what gen_reports -f/-b pays) against also importing
+the web api and openpyxl (what every run paid when they were imported eagerly)
+
+usage: python benchmarks/import_time.py [-n runs]
+"""
+
+import subprocess, sys
+import time
+from optparse import OptionParser
+
+STATEMENTS = [
+    ("cli", "import supplier_reports"),
+    ("cli+webapi+openpyxl", "import supplier_reports, supplier_reports.webapi.app, openpyxl"),
+]
+
+
+def time_cold_import(statement, runs):
+    timings = []
+    for x in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c", statement])
+        timings.append(time.time() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--runs", dest="runs", type="int", default=10, help="cold starts per statement")
+    options, args = parser.parse_args()
+    for name, statement in STATEMENTS:
+        print("{:<22} median {:.3f}s over {} runs".format(name, time_cold_import(statement, options.runs), options.runs))
+
+
+if __name__ == "__main__":
+    main()
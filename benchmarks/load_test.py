@@ -0,0 +1,151 @@
+"""
+local load test for the web api, several concurrent uploads against a server subprocess
+
+every upload is a different export so each one runs the report pipeline, --same-upload posts one export
+over and over and so measures the report cache instead
+
+usage: python benchmarks/load_test.py [--mode prod|dev] [--processes N] [-c concurrency] [-u uploads] [--orders N]
+                                      [--same-upload]
+"""
+
+import os, sys
+import subprocess
+import socket
+import tempfile, shutil
+import threading
+import time
+from optparse import OptionParser
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
+from sample_export import create_sample_export
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVER = """
+from supplier_reports import conf as g
+g.config.root.reports_dir = {reports_dir!r}
+g.config.root.debug = {debug!r}
+from supplier_reports.webapi import app
+if {debug!r}:
+    app.enable_debugger()
+    app.app.run(port={port}, threaded=False, use_reloader=False)
+else:
+    app.serve(port={port}, processes={processes})
+"""
+
+
+def get_free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start on port {}".format(port))
+
+
+def multipart_body(file_name, content, boundary="----supplier-reports-load-test"):
+    body = b"".join([b"--", boundary.encode(), b"\r\n",
+                     'Content-Disposition: form-data; name="file"; filename="{}"\r\n'.format(file_name).encode(),
+                     b"Content-Type: application/octet-stream\r\n\r\n", content, b"\r\n",
+                     b"--", boundary.encode(), b"--\r\n"])
+    return body, "multipart/form-data; boundary={}".format(boundary)
+
+
+def upload(port, body, content_type):
+    start = time.time()
+    conn = httplib.HTTPConnection("127.0.0.1", port, timeout=300)
+    conn.request("POST", "/", body, {"Content-Type": content_type})
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.status, time.time() - start
+
+
+def run_load(port, bodies, content_type, concurrency):
+    """ post each of bodies once """
+    results = []
+    lock = threading.Lock()
+    remaining = list(bodies)
+
+    def worker():
+        while True:
+            with lock:
+                if not remaining:
+                    return
+                body = remaining.pop()
+            result = upload(port, body, content_type)
+            with lock:
+                results.append(result)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for x in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.time() - start
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--mode", dest="mode", type="choice", choices=["dev", "prod"], default="prod")
+    parser.add_option("--processes", dest="processes", type="int", default=1)
+    parser.add_option("-c", "--concurrency", dest="concurrency", type="int", default=4)
+    parser.add_option("-u", "--uploads", dest="uploads", type="int", default=20)
+    parser.add_option("--orders", dest="orders", type="int", default=500)
+    parser.add_option("--same-upload", dest="same_upload", action="store_true", default=False)
+    options, args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    server = None
+    try:
+        reports_dir = os.path.join(work_dir, "reports")
+        os.mkdir(reports_dir)
+        bodies = []
+        for seed in range(1 if options.same_upload else options.uploads):
+            export_path = create_sample_export(os.path.join(work_dir, "load_test.xlsx"), orders=options.orders,
+                                               seed=seed)
+            with open(export_path, "rb") as fo:
+                body, content_type = multipart_body("load_test.xlsx", fo.read())
+            bodies.append(body)
+        if options.same_upload:
+            bodies *= options.uploads
+
+        port = get_free_port()
+        code = SERVER.format(reports_dir=reports_dir, debug=options.mode == "dev", port=port,
+                             processes=options.processes)
+        with open(os.devnull, "w") as devnull:
+            server = subprocess.Popen([sys.executable, "-c", code], cwd=REPO_DIR, stdout=devnull, stderr=devnull)
+            wait_for_port(port)
+            results, elapsed = run_load(port, bodies, content_type, options.concurrency)
+
+        latencies = sorted(r[1] for r in results)
+        failed = len([r for r in results if r[0] != 200])
+        print("mode={} processes={} concurrency={} uploads={} orders={} same upload={}".format(
+            options.mode, options.processes, options.concurrency, options.uploads, options.orders,
+            options.same_upload))
+        print("throughput {:.2f} uploads/s, median {:.3f}s, p95 {:.3f}s, failed {}".format(
+            len(results) / elapsed, latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.95) - 1], failed))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+synthetic "Export orders"/"Product list" workbooks for the benchmarks
+"""
+
+from collections import OrderedDict
+import random
+
+VENDORS = ["Zhen", "Mr Art Painting store"]
+
+SHIPPING_FIELDS = ["Shipping Name", "Shipping Street", "Shipping Address1", "Shipping Address2", "Shipping Company",
+                   "Shipping City", "Shipping Zip", "Shipping Province", "Shipping Country", "Phone", "Billing Phone",
+                   "Shipping Phone", "Notes"]
+
+
+def product_list_rows(products_per_vendor=50):
+    rows = []
+    for vendor in VENDORS:
+        for p in range(products_per_vendor):
+            rows.append(OrderedDict([("Vendor", vendor), ("Lineitem name", "product {}".format(p)),
+                                     ("Product link", "http://example.com/{}/{}".format(vendor.replace(" ", "_"), p))]))
+    return rows
+
+
+def export_orders_rows(orders, lines_per_order=3, products_per_vendor=50, seed=0):
+    rnd = random.Random(seed)
+    rows = []
+    for o in range(orders):
+        for line in range(lines_per_order):
+            row = OrderedDict([("Name", "#{}".format(1000 + o)), ("Vendor", rnd.choice(VENDORS)),
+                               ("Lineitem name", "product {}".format(rnd.randrange(products_per_vendor))),
+                               ("Variant", "v1"), ("Lineitem quantity", 1), ("Created at", "2018-02-14"),
+                               ("Fulfillment Status", "pending"), ("Lineitem sku", "sku{}".format(o)),
+                               ("Size", "M"), ("Color", "red"), ("Frame option", "none")])
+            for field in SHIPPING_FIELDS:
+                # shopify only fills the shipping details on the first line of an order
+                row[field] = "{} {}".format(field, o) if line == 0 else None
+            rows.append(row)
+    return rows
+
+
+def create_sample_export(file_path, orders=1000, lines_per_order=3, products_per_vendor=50, seed=0):
+    """ :param seed: of the order lines, exports of different seeds have different content """
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    for title, rows in (("Export orders", export_orders_rows(orders, lines_per_order, products_per_vendor, seed)),
+                        ("Product list", product_list_rows(products_per_vendor))):
+        ws = wb.create_sheet(title=title)
+        ws.append(list(rows[0].keys()))
+        for row in rows:
+            ws.append(list(row.values()))
+    wb.save(file_path)
+    return file_path
+
+
+def create_sample_csv_bundle(file_path, orders=1000, lines_per_order=3, products_per_vendor=50):
+    """ the same sheets as create_sample_export, as <sheet name>.csv members of a zip """
+    import io, zipfile
+    import unicodecsv as csv
+    with zipfile.ZipFile(file_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for title, rows in (("Export orders", export_orders_rows(orders, lines_per_order, products_per_vendor)),
+                            ("Product list", product_list_rows(products_per_vendor))):
+            buf = io.BytesIO()
+            writer = csv.writer(buf, encoding="utf-8")
+            writer.writerow(list(rows[0].keys()))
+            for row in rows:
+                writer.writerow(["" if v is None else v for v in row.values()])
+            archive.writestr(title + ".csv", buf.getvalue())
+    return file_path
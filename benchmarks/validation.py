@@ -0,0 +1,42 @@
+"""
+validation benchmark, validate_table of the export orders and product list rows of a synthetic export
+
+usage: python benchmarks/validation.py [-o orders] [-n runs]
+"""
+
+import os, sys
+import copy
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sample_export import export_orders_rows, product_list_rows
+from supplier_reports.gen_reports import SimpleSchemaValidator, schema_export_orders, schema_product_list
+
+
+def time_validate(schema, rows, post_process, runs):
+    timings = []
+    for x in range(runs):
+        table = copy.deepcopy(rows)
+        start = time.time()
+        SimpleSchemaValidator(schema).validate_table(table, post_process=post_process)
+        timings.append(time.time() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-o", "--orders", dest="orders", type="int", default=5000, help="orders in the sample export")
+    parser.add_option("-n", "--runs", dest="runs", type="int", default=3, help="validations per sheet")
+    options, args = parser.parse_args()
+    sheets = [("Export orders", schema_export_orders, list(export_orders_rows(options.orders)), True),
+              ("Product list", schema_product_list, list(product_list_rows()), False)]
+    for name, schema, rows, post_process in sheets:
+        elapsed = time_validate(schema, rows, post_process, options.runs)
+        print("{:<14} {:>8} rows  median {:.3f}s over {} runs, {:.0f} rows/s".format(
+            name, len(rows), elapsed, options.runs, len(rows) / elapsed))
+
+
+if __name__ == "__main__":
+    main()
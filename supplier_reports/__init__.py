@@ -1,17 +1,19 @@
 import os,sys
-from supplier_reports.python_script_common import set_logging, trace_call, info
+from supplier_reports.python_script_common import (set_logging, trace_call, info, profiling_context,
+                                                   get_profile_stats_path)
 from supplier_reports import conf as g
 import logging
-from openpyxl import load_workbook
 import copy
 import contextlib
 import os
 import csv
 import traceback, pdb
+import glob
+import time
+import datetime
+import multiprocessing
+import functools
 from supplier_reports import gen_reports
-from supplier_reports.webapi import app
-import StringIO
-from werkzeug.datastructures import FileStorage
 #####################################################################
 #Globals
 _logger = logging.getLogger(__name__)
@@ -24,8 +26,33 @@ def get_opts():
     parser = OptionParser()
     parser.add_option("-v", "--verbose" , dest="verbose", action="count", default=0, help="set verbosity level, default is NOTICE")
     parser.add_option('--pdb', dest='pdb', action='store_true', default=False, help='enable pdb on exception')
-    parser.add_option("-f", '--file', dest='file', action='store', help='file path for source report of suppliers reports')
+    parser.add_option("-f", '--file', dest='file', action='store', help='source of suppliers reports: xlsx workbook, zip of csv sheets or directory of csv sheets')
     parser.add_option("-w", '--webapi', dest='webapi', action='store_true', default=False)
+    parser.add_option('--webapi-mode', dest='webapi_mode', type='choice', choices=['dev', 'prod'], default='dev',
+                      help='dev: single process server with the debugger, prod: multi worker server without it')
+    parser.add_option('--webapi-processes', dest='webapi_processes', action='store', type='int', default=None,
+                      help='prod server processes, 1 serves with threads, default from conf')
+    parser.add_option("-b", '--batch', dest='batch', action='store',
+                      help='directory or glob of source reports, each is processed in a worker process')
+    parser.add_option("-m", '--merge', dest='merge', action='store',
+                      help='directory or glob of source reports merged into one report per supplier')
+    parser.add_option('--merge-name', dest='merge_name', action='store', default='merged',
+                      help='reports prefix for --merge, default is merged')
+    parser.add_option("-j", '--jobs', dest='jobs', action='store', type='int', default=multiprocessing.cpu_count(),
+                      help='number of worker processes for --batch and --merge, default is cpu count')
+    parser.add_option('--order-store', dest='order_store', action='store', default=None,
+                      help='sqlite order store path, sources are stored in it, default from conf order_store_path')
+    parser.add_option('--from-store', dest='from_store', action='store_true', default=False,
+                      help='generate reports from the orders in the order store instead of a source file')
+    parser.add_option('--vendor', dest='vendor', action='store', default=None,
+                      help='with --from-store, only orders of this vendor')
+    parser.add_option('--since-days', dest='since_days', action='store', type='int', default=None,
+                      help='with --from-store, only orders created in the last N days')
+    parser.add_option('--import-catalogue', dest='import_catalogue', action='store', default=None,
+                      help='source whose product list becomes the catalogue of the disk lookup backend')
+    parser.add_option('--profile', dest='profile', action='store_true', default=False,
+                      help='run report generation under cProfile, stats are saved as .prof in reports_dir, one per '
+                           'file with --batch, one per run otherwise (of the main process only with --merge)')
     # parser.add_option("-l", '--load-latest', dest='load_latest', action='store_false', default=True,
     #                   help='do not load latest state from db')
     # parser.add_option("-t", '--test-site', dest='test_site', action='store', default=None, help='test latest update via this url, also sets load_latest to False, and does not update db')
@@ -39,6 +66,8 @@ def process_config():
         sys.excepthook = info
     log_file_path = set_logging(app_name="supplier_reports", app_path=g.config.root.app_path, verbose=options.verbose, file_handler=True)
     g.config.extend(dict(options=vars(options),args=args, log_file_path=log_file_path))
+    if options.order_store:
+        g.config.root.order_store_path = options.order_store
     return parser
 
 
@@ -48,20 +77,127 @@ def get_filename_from_path(filepath):
     return name
 
 
+def get_batch_file_paths(dir_or_glob):
+    if os.path.isdir(dir_or_glob):
+        return sorted(glob.glob(os.path.join(dir_or_glob, "*.xlsx")) + glob.glob(os.path.join(dir_or_glob, "*.zip")))
+    return sorted(glob.glob(dir_or_glob))
+
+
+def process_batch_file(file_path, profile=False):
+    """ batch worker, generates and saves the reports of a single source file
+
+    :param file_path:
+    :param profile: save the cProfile stats of the file in reports_dir
+    :return: (file_path, saved reports count, seconds, error or None)
+    """
+    start = time.time()
+    saved = 0
+    try:
+        stats_path = get_profile_stats_path(g.config.root.reports_dir, get_filename_from_path(file_path))
+        with profiling_context(stats_path, enabled=profile):
+            for report in gen_reports.gen_reports(file_path):
+                if report is not None:
+                    report.save(g.config.root.reports_dir)
+                    saved += 1
+        error = None
+    except Exception as e:
+        _logger.exception("failed processing {}".format(file_path))
+        error = repr(e)
+    return file_path, saved, time.time() - start, error
+
+
+def format_batch_summary(results):
+    name_width = max([len("file")] + [len(os.path.basename(r[0])) for r in results])
+    row_format = "{:<%d}  {:>7}  {:>8}  {}" % name_width
+    lines = [row_format.format("file", "reports", "seconds", "status")]
+    for file_path, saved, elapsed, error in results:
+        lines.append(row_format.format(os.path.basename(file_path), saved, "%.2f" % elapsed, error or "ok"))
+    return "\n".join(lines)
+
+
+def run_batch(dir_or_glob, jobs, profile=False):
+    file_paths = get_batch_file_paths(dir_or_glob)
+    if not file_paths:
+        raise IOError("no source files found for '{}'".format(dir_or_glob))
+    _logger.info("processing {} files with {} workers".format(len(file_paths), jobs))
+    pool = multiprocessing.Pool(processes=max(1, min(jobs, len(file_paths))))
+    try:
+        results = pool.map(functools.partial(process_batch_file, profile=profile), file_paths, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    print(format_batch_summary(results))
+    return results
+
+
+def run_merge(dir_or_glob, jobs, name):
+    file_paths = get_batch_file_paths(dir_or_glob)
+    if not file_paths:
+        raise IOError("no source files found for '{}'".format(dir_or_glob))
+    _logger.info("merging {} files with {} workers".format(len(file_paths), jobs))
+    saved = []
+    for report in gen_reports.gen_merged_reports(file_paths, name=name, jobs=jobs):
+        if report is not None:
+            report.save(g.config.root.reports_dir)
+            saved.append(report.get_report_file_name())
+    return saved
+
+
+def run_store_reports(name="store", vendor=None, since_days=None):
+    store_path = g.config.root.order_store_path
+    if not store_path or not os.path.isfile(store_path):
+        raise IOError("no order store at '{}', set --order-store or conf order_store_path".format(store_path))
+    since = datetime.date.today() - datetime.timedelta(days=since_days) if since_days is not None else None
+    saved = []
+    for report in gen_reports.gen_store_reports(store_path, name=name, vendor=vendor, since=since):
+        if report is not None:
+            report.save(g.config.root.reports_dir)
+            saved.append(report.get_report_file_name())
+    return saved
+
+
 def main():
     try:
         parser = process_config()
         #g.config.extend(dict(db_latest=db_latest))
-        if g.config.root.options.file:
-            assert os.path.isfile(g.config.root.options.file)
-            fo = StringIO.StringIO()
-            fo.write(open(g.config.root.options.file).read())
-            fs = FileStorage(fo, filename=get_filename_from_path(g.config.root.options.file))
-            for report in gen_reports.gen_reports(fs):
-                if report:
-                    report.save(g.config.root.reports_dir)
+        profile = g.config.root.options.profile
+        if profile and g.config.root.options.webapi:
+            parser.error("--profile does not apply to --webapi, post an upload to /?profile=1 of the development "
+                         "server (--webapi-mode dev) instead")
+        if g.config.root.options.import_catalogue:
+            file_path = g.config.root.options.import_catalogue
+            stats_path = get_profile_stats_path(g.config.root.reports_dir, get_filename_from_path(file_path))
+            with profiling_context(stats_path, enabled=profile):
+                gen_reports.import_product_catalogue(file_path)
+        elif g.config.root.options.file:
+            file_path = g.config.root.options.file
+            assert os.path.exists(file_path)
+            stats_path = get_profile_stats_path(g.config.root.reports_dir, get_filename_from_path(file_path))
+            with profiling_context(stats_path, enabled=profile):
+                for report in gen_reports.gen_reports(file_path):
+                    if report is not None:
+                        report.save(g.config.root.reports_dir)
+        elif g.config.root.options.batch:
+            results = run_batch(g.config.root.options.batch, g.config.root.options.jobs, profile=profile)
+            failed = [file_path for file_path, saved, seconds, error in results if error is not None]
+            if failed:
+                _logger.error("{} of {} files failed".format(len(failed), len(results)))
+                sys.exit(1)
+        elif g.config.root.options.merge:
+            stats_path = get_profile_stats_path(g.config.root.reports_dir, g.config.root.options.merge_name)
+            with profiling_context(stats_path, enabled=profile):
+                run_merge(g.config.root.options.merge, g.config.root.options.jobs, g.config.root.options.merge_name)
+        elif g.config.root.options.from_store:
+            stats_path = get_profile_stats_path(g.config.root.reports_dir, "store")
+            with profiling_context(stats_path, enabled=profile):
+                run_store_reports(vendor=g.config.root.options.vendor, since_days=g.config.root.options.since_days)
         elif g.config.root.options.webapi:
-            webapi.app.main()
+            # flask and the debugger are only imported when serving
+            from supplier_reports.webapi import app as webapi_app
+            if g.config.root.options.webapi_mode == 'prod':
+                webapi_app.serve(processes=g.config.root.options.webapi_processes)
+            else:
+                webapi_app.main()
         else:
             parser.print_help()
     except Exception as e:
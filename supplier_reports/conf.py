@@ -6,7 +6,43 @@ app_path=os.path.dirname(os.path.abspath(__file__))
 options = dict(
     app_path=app_path,
     reports_dir=os.path.join(app_path,"reports"),
-    debug=True
+    debug=True,
+    # supplier report schemas, reloaded when the file changes
+    report_schemas_path=os.path.join(app_path, "report_schemas.json"),
+    webapi_host="0.0.0.0",
+    webapi_port=8999,
+    # production server, 1 serves each request in a thread, >1 forks up to that many request processes
+    webapi_processes=1,
+    # reports are overwritten in place, 0 makes browsers revalidate (cheap 304) on every reload
+    reports_cache_timeout=0,
+    # save a .gz sibling next to each report of a web upload
+    precompress_reports=True,
+    # uploads larger than this are rejected with 413 while they stream in
+    max_upload_size=64*1024*1024,
+    # identical uploads are answered from the report cache, bounded by entries and report bytes, the upload
+    # directory of an evicted entry is removed unless it is the latest upload (of its source)
+    report_cache_entries=128,
+    report_cache_bytes=512*1024*1024,
+    # every web upload keeps its directory under reports_dir/uploads, pruned to the latest uploads of each source
+    # after each upload (the published latest ones are always kept), 0 keeps them all
+    uploads_kept_per_source=20,
+    # rows per page of the /view/ report viewer
+    viewer_page_size=200,
+    # sqlite file keeping the validated rows of every source for --from-store reports, None disables it
+    order_store_path=None,
+    # product lookup: "memory" reads the product list of every source into dicts, "disk" memory maps the
+    # catalogue imported once with --import-catalogue, shared by all workers, sources then need no product list
+    lookup_backend="memory",
+    product_lookup_path=os.path.join(app_path, "lookups", "products.lookup"),
+    # memory guard: sources over max_source_rows or max_source_columns are rejected before parsing (or while
+    # read, for sheets without dimensions), sources estimated (rows * columns * source_cell_bytes) not to fit the
+    # rss budget are streamed instead of loaded, and a run whose rss grows by more than rss_budget since it
+    # started is aborted, 0 disables a limit. concurrent uploads of the threaded web server share one process,
+    # so each one also counts the growth of the others: size the budget for the concurrent runs expected
+    max_source_rows=1000000,
+    max_source_columns=256,
+    rss_budget=1024*1024*1024,
+    source_cell_bytes=600,
 )
 
 config = Config()
@@ -0,0 +1,124 @@
+"""
+on disk product lookup for large product catalogues (conf lookup_backend = "disk")
+
+the product catalogue is imported once (--import-catalogue) into a single lookup file, streamed row by row,
+and every report run opens it through a read only mmap, so all worker processes share the same page cache
+pages instead of each parsing the product list of every upload into its own dicts:
+
+    magic | uint32 header length | json header (fields, fields_in_index, count)
+    | count + 1 uint64 record offsets | records sorted by key, each <key>\\0<json row>
+
+lookups are a binary search over the offsets, O(log n) record reads.
+"""
+
+import os
+import json
+import mmap
+import struct
+import logging
+import tempfile
+from collections import OrderedDict
+from supplier_reports.python_script_common import atomic_write
+from supplier_reports.gen_reports import LookupBase, get_index_string
+
+_logger = logging.getLogger(__name__)
+
+MAGIC = b"SRLOOKUP1\n"
+HEADER_LENGTH = struct.Struct("<I")
+OFFSET = struct.Struct("<Q")
+
+
+def dump_row(rowdict):
+    return json.dumps(list(rowdict.items()), default=lambda value: u"{}".format(value))
+
+
+def build_disk_lookup(path, rows, fields_in_index):
+    """ write the lookup file of rows, a later row with the same key wins as in LookupDict
+
+    rows are consumed one at a time and spooled to a temporary file, only their keys and spool offsets
+    are kept in memory until the records are copied out in key order
+    :param rows: iterable of dicts, e.g. a streamed sheet
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    records = {}
+    fields = None
+    spool = tempfile.TemporaryFile(dir=directory)
+    try:
+        for rowdict in rows:
+            if fields is None:
+                fields = list(rowdict.keys())
+            data = dump_row(rowdict)
+            records[get_index_string(rowdict, fields_in_index)] = (spool.tell(), len(data))
+            spool.write(data)
+        if fields is None:
+            raise ValueError("no rows for the lookup {}".format(path))
+        keys = sorted(records)
+        offsets = [0]
+        for key in keys:
+            offsets.append(offsets[-1] + len(key) + 1 + records[key][1])
+        header = json.dumps(OrderedDict([("fields", fields), ("fields_in_index", fields_in_index),
+                                         ("count", len(keys))]))
+        with atomic_write(path) as f:
+            f.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+            f.write(struct.pack("<{}Q".format(len(offsets)), *offsets))
+            for key in keys:
+                start, length = records[key]
+                spool.seek(start)
+                f.write(key + b"\0" + spool.read(length))
+    finally:
+        spool.close()
+    _logger.info("built lookup of {} rows at {}".format(len(records), path))
+    return path
+
+
+class DiskLookupDict(LookupBase):
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buf[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a lookup file".format(path))
+        header_length, = HEADER_LENGTH.unpack_from(self.buf, len(MAGIC))
+        header_start = len(MAGIC) + HEADER_LENGTH.size
+        header = json.loads(self.buf[header_start:header_start + header_length])
+        self.fields = header["fields"]
+        self.fields_in_index = header["fields_in_index"]
+        self.count = header["count"]
+        self.offsets_start = header_start + header_length
+        self.records_start = self.offsets_start + OFFSET.size * (self.count + 1)
+        self.projections = {}
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.buf.close()
+
+    def get_record(self, i):
+        """ :return: key, json row of the i'th record """
+        start, end = struct.unpack_from("<2Q", self.buf, self.offsets_start + OFFSET.size * i)
+        record = self.buf[self.records_start + start:self.records_start + end]
+        key, _, data = record.partition(b"\0")
+        return key, data
+
+    def keys(self):
+        return [self.get_record(i)[0] for i in range(self.count)]
+
+    def get_matching_dict_for(self, rdict):
+        idx = self.create_index_string(rdict)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key, data = self.get_record(mid)
+            if key == idx:
+                return OrderedDict(json.loads(data))
+            if key < idx:
+                lo = mid + 1
+            else:
+                hi = mid
+        raise self.lookup_key_error(idx)
@@ -1,13 +1,19 @@
 import logging
-from openpyxl import load_workbook
 import copy
 import contextlib
 import os
 import unicodecsv as csv
-from werkzeug.datastructures import FileStorage
 import functools,StringIO
+import mmap
+import zipfile
+from xml.etree import cElementTree
 from collections import OrderedDict
-from python_script_common import exception_context_extra_info
+import hashlib
+import json
+import re
+import struct
+from python_script_common import exception_context_extra_info, write_gzip_sibling, atomic_write, get_rss
+import conf as g
 
 #####################################################################
 #Globals
@@ -42,9 +48,131 @@ def lcs(xstr, ystr):
 #####################################################################
 # move to env utiliy funcs
 
+# rows between two progress callbacks
+PROGRESS_EVERY = 500
 
-def read_xlsx_sheet(file_path, sheet_name):
-    wb = load_workbook(file_path)
+
+def iter_progress(rows, progress, stage, total=None):
+    """ yield rows, calling progress(stage, rows done, total) every PROGRESS_EVERY rows and once at the end
+
+    :param progress: callable or None
+    """
+    if progress is None:
+        for rowdict in rows:
+            yield rowdict
+        return
+    done = 0
+    progress(stage, done, total)
+    for rowdict in rows:
+        yield rowdict
+        done += 1
+        if done % PROGRESS_EVERY == 0:
+            progress(stage, done, total)
+    if done % PROGRESS_EVERY:
+        progress(stage, done, total)
+
+
+class MmapReader(object):
+    """ file like view of an mmap buffer, py2 mmap.read() does not accept a missing size """
+    def __init__(self, buf):
+        self.buf = buf
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.buf) - self.buf.tell()
+        return self.buf.read(size)
+
+    def __getattr__(self, name):
+        return getattr(self.buf, name)
+
+
+def is_file_storage(source):
+    """ duck typed werkzeug FileStorage check, avoids importing werkzeug on the CLI path """
+    return hasattr(source, "stream") and hasattr(source, "filename")
+
+
+EXPORT_ORDERS_SHEET = "Export orders"
+PRODUCT_LIST_SHEET = "Product list"
+REQUIRED_SHEETS = (EXPORT_ORDERS_SHEET, PRODUCT_LIST_SHEET)
+
+XLSX_MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+XLSX_REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+XLSX_PACKAGE_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+
+def get_source_stream(source):
+    """ path or rewound file like object for source, FileStorage and mmap are unwrapped without copying """
+    if is_file_storage(source):
+        source = source.stream
+    elif isinstance(source, mmap.mmap):
+        source = MmapReader(source)
+    if hasattr(source, "seek"):
+        source.seek(0)
+    return source
+
+
+def load_source_workbook(source):
+    """ load the workbook once straight from the source, without copying its bytes
+
+    :param source: file path, FileStorage, file object or mmap buffer
+    :return: openpyxl Workbook
+    """
+    from openpyxl import load_workbook
+    return load_workbook(get_source_stream(source))
+
+
+def get_xlsx_sheet_names(source):
+    """ sheet names read from the zip directory and xl/workbook.xml only, without parsing any sheet """
+    try:
+        with zipfile.ZipFile(get_source_stream(source)) as archive:
+            workbook_xml = archive.open("xl/workbook.xml")
+            return [el.get("name") for event, el in cElementTree.iterparse(workbook_xml)
+                    if el.tag == "{%s}sheet" % XLSX_MAIN_NS]
+    except (zipfile.BadZipfile, KeyError, SyntaxError) as e:
+        raise ParsingError("not an xlsx workbook: {}".format(e))
+
+
+def get_xlsx_sheet_member(archive, sheet_name):
+    """ zip member name of a sheet, through its relationship id in xl/workbook.xml """
+    rel_ids = dict((el.get("name"), el.get("{%s}id" % XLSX_REL_NS))
+                   for event, el in cElementTree.iterparse(archive.open("xl/workbook.xml"))
+                   if el.tag == "{%s}sheet" % XLSX_MAIN_NS)
+    targets = dict((el.get("Id"), el.get("Target"))
+                   for event, el in cElementTree.iterparse(archive.open("xl/_rels/workbook.xml.rels"))
+                   if el.tag == "{%s}Relationship" % XLSX_PACKAGE_REL_NS)
+    target = targets[rel_ids[sheet_name]]
+    return target.lstrip("/") if target.startswith("/") else "xl/" + target
+
+
+def get_column_number(letters):
+    number = 0
+    for letter in letters.upper():
+        number = number * 26 + ord(letter) - ord("A") + 1
+    return number
+
+
+def get_xlsx_sheet_dimensions(source, sheet_name):
+    """ data rows, columns of a sheet from the dimension element at the head of its xml, the rest of the
+        sheet and the shared strings are not parsed
+
+    :return: None when the sheet has no dimension element, or only a single cell one
+    """
+    with zipfile.ZipFile(get_source_stream(source)) as archive:
+        sheet_xml = archive.open(get_xlsx_sheet_member(archive, sheet_name))
+        for event, el in cElementTree.iterparse(sheet_xml, events=("start",)):
+            if el.tag == "{%s}dimension" % XLSX_MAIN_NS:
+                match = re.match(r"^[A-Z]+\d+:([A-Z]+)(\d+)$", el.get("ref", ""), re.I)
+                if match is None:
+                    return None
+                return int(match.group(2)) - 1, get_column_number(match.group(1))
+            if el.tag == "{%s}sheetData" % XLSX_MAIN_NS:
+                return None
+    return None
+
+
+def read_xlsx_sheet(source, sheet_name, progress=None):
+    from openpyxl import Workbook
+    wb = source if isinstance(source, Workbook) else load_source_workbook(source)
     assert sheet_name in wb, "no such sheet name {}".format(sheet_name)
     sheet = wb[sheet_name]
     row_count = sheet.max_row
@@ -56,11 +184,168 @@ def read_xlsx_sheet(file_path, sheet_name):
         header.append(sheet.cell(1, col).value)
 
     data = []
-    for row in range(2, row_count+1):
+    for row in iter_progress(range(2, row_count+1), progress, "reading '{}'".format(sheet_name), row_count-1):
         rdict = OrderedDict([(header[col-1],sheet.cell(row, col).value) for col in range(1, column_count+1)])
         data.append(rdict)
     return data
 
+
+def iter_xlsx_sheet(source, sheet_name):
+    """ rows of a sheet as read_xlsx_sheet, streamed from a read only workbook one row at a time """
+    from openpyxl import load_workbook
+    wb = load_workbook(get_source_stream(source), read_only=True)
+    try:
+        assert sheet_name in wb, "no such sheet name {}".format(sheet_name)
+        rows = wb[sheet_name].rows
+        try:
+            header = [cell.value for cell in next(rows)]
+        except StopIteration:
+            return
+        for row in rows:
+            values = [cell.value for cell in row][:len(header)]
+            yield OrderedDict(zip(header, values + [None] * (len(header) - len(values))))
+    finally:
+        wb.close()
+
+
+def iter_csv_sheet(fileobj):
+    """ rows of a csv sheet as OrderedDicts, empty cells are None like empty xlsx cells """
+    reader = csv.reader(fileobj, encoding="utf-8-sig")
+    try:
+        header = next(reader)
+    except StopIteration:
+        return
+    for values in reader:
+        if not any(values):
+            continue
+        values = [v if v != "" else None for v in values] + [None] * (len(header) - len(values))
+        yield OrderedDict(zip(header, values))
+
+
+def get_csv_dimensions(fileobj):
+    """ :return: data rows, columns of a csv sheet, rows counted as lines so quoted line breaks over count """
+    header = next(csv.reader([fileobj.readline()], encoding="utf-8-sig"), [])
+    return sum(1 for line in fileobj if line.strip()), len(header)
+
+#####################################################################
+# table sources, every source reads sheets by name into the same rows
+
+
+def get_csv_sheet_key(file_name):
+    """ 'Export orders.csv', 'export_orders.csv' and 'dir/Export Orders.CSV' all name the 'Export orders' sheet """
+    name, ext = os.path.splitext(os.path.basename(file_name))
+    return name.lower().replace(" ", "_") if ext.lower() == ".csv" else None
+
+
+class XlsxSource(object):
+    """ sheets of an xlsx workbook, loaded once on the first read """
+    def __init__(self, source):
+        self.source = source
+        self.workbook = None
+
+    def sheet_names(self):
+        return get_xlsx_sheet_names(self.source)
+
+    def read_sheet(self, sheet_name, progress=None):
+        if self.workbook is None:
+            self.workbook = load_source_workbook(self.source)
+        return read_xlsx_sheet(self.workbook, sheet_name, progress)
+
+    def iter_sheet(self, sheet_name):
+        return iter_xlsx_sheet(self.source, sheet_name)
+
+    def sheet_dimensions(self, sheet_name):
+        """ :return: data rows, columns of the sheet from its dimension element, None when unknown """
+        return get_xlsx_sheet_dimensions(self.source, sheet_name)
+
+
+class CsvZipSource(object):
+    """ sheets as <sheet name>.csv members of a zip bundle """
+    def __init__(self, source):
+        self.source = source
+
+    def get_members(self, archive):
+        return dict((get_csv_sheet_key(name), name) for name in archive.namelist() if get_csv_sheet_key(name))
+
+    def sheet_names(self):
+        with zipfile.ZipFile(get_source_stream(self.source)) as archive:
+            return [os.path.splitext(os.path.basename(name))[0] for name in self.get_members(archive).values()]
+
+    def read_sheet(self, sheet_name, progress=None):
+        return list(iter_progress(self.iter_sheet(sheet_name), progress, "reading '{}'".format(sheet_name)))
+
+    def iter_sheet(self, sheet_name):
+        with zipfile.ZipFile(get_source_stream(self.source)) as archive:
+            member = self.get_members(archive).get(get_csv_sheet_key(sheet_name + ".csv"))
+            assert member, "no such sheet name {}".format(sheet_name)
+            for rowdict in iter_csv_sheet(archive.open(member)):
+                yield rowdict
+
+    def sheet_dimensions(self, sheet_name):
+        with zipfile.ZipFile(get_source_stream(self.source)) as archive:
+            return get_csv_dimensions(archive.open(self.get_members(archive)[get_csv_sheet_key(sheet_name + ".csv")]))
+
+
+class CsvDirSource(object):
+    """ sheets as <sheet name>.csv files of a directory """
+    def __init__(self, path):
+        self.path = path
+
+    def get_files(self):
+        return dict((get_csv_sheet_key(name), name) for name in os.listdir(self.path) if get_csv_sheet_key(name))
+
+    def sheet_names(self):
+        return [os.path.splitext(name)[0] for name in self.get_files().values()]
+
+    def read_sheet(self, sheet_name, progress=None):
+        return list(iter_progress(self.iter_sheet(sheet_name), progress, "reading '{}'".format(sheet_name)))
+
+    def iter_sheet(self, sheet_name):
+        file_name = self.get_files().get(get_csv_sheet_key(sheet_name + ".csv"))
+        assert file_name, "no such sheet name {}".format(sheet_name)
+        with open(os.path.join(self.path, file_name), "rb") as f:
+            for rowdict in iter_csv_sheet(f):
+                yield rowdict
+
+    def sheet_dimensions(self, sheet_name):
+        with open(os.path.join(self.path, self.get_files()[get_csv_sheet_key(sheet_name + ".csv")]), "rb") as f:
+            return get_csv_dimensions(f)
+
+
+def open_table_source(source):
+    """ detect the format of source: an xlsx workbook, a zip bundle of csv sheets or a directory of csv sheets
+
+    :param source: directory path, or file path, FileStorage, file object or mmap buffer
+    """
+    if isinstance(source, basestring) and os.path.isdir(source):
+        return CsvDirSource(source)
+    try:
+        with zipfile.ZipFile(get_source_stream(source)) as archive:
+            names = archive.namelist()
+    except zipfile.BadZipfile as e:
+        raise ParsingError("not an xlsx workbook or a zip of csv sheets: {}".format(e))
+    if "xl/workbook.xml" in names:
+        return XlsxSource(source)
+    if any(get_csv_sheet_key(name) for name in names):
+        return CsvZipSource(source)
+    raise ParsingError("zip holds neither an xlsx workbook nor csv sheets")
+
+
+def check_source_sheets(table_source, sheet_names=REQUIRED_SHEETS):
+    """ fail fast on a source missing sheets, before any sheet is parsed """
+    found = table_source.sheet_names()
+    found_keys = set(get_csv_sheet_key(name + ".csv") for name in found)
+    missing = [name for name in sheet_names if name not in found and get_csv_sheet_key(name + ".csv") not in found_keys]
+    if missing:
+        raise ParsingError("missing sheets {}, the source has {}".format(missing, found))
+
+
+def read_sheet(source, sheet_name, progress=None):
+    """ :param progress: callable(stage, rows done, total), total is None when unknown until the end """
+    if hasattr(source, "read_sheet"):
+        return source.read_sheet(sheet_name, progress)
+    return read_xlsx_sheet(source, sheet_name, progress)
+
 #####################################################################
 # errors
 
@@ -88,36 +373,72 @@ class GroupingError(Exception):
 class EmptyValueError(Exception):
     pass
 
+
+class SchemaError(Exception):
+    pass
+
+
+class ResourceLimitError(Exception):
+    pass
+
 #####################################################################
 # general schema validators
 
 
-class LookupDict(dict):
+def get_index_string(rdict, fields_in_index):
+    index_values = [rdict[key] for key in fields_in_index]
+    index_string = "_".join(map(str, index_values))
+    return index_string
+
+
+class LookupBase(object):
+    """ lookup of product rows by the values of fields_in_index, see LookupDict and disk_lookup.DiskLookupDict
+
+    subclasses set fields, fields_in_index and projections, and implement get_matching_dict_for and keys
+    """
+    def create_index_string(self, rdict):
+        return get_index_string(rdict, self.fields_in_index)
+
+    def lookup_key_error(self, idx):
+        similar=get_similar_strings(idx, self.keys())
+        s=[]
+        for x in similar:
+            s.append(x[0][:len(x[1])]+"<-similar_to_here,diffrent->"+x[0][len(x[1]):])
+        return LookupKeyError("unable to lookup key '{}', the similar (but different) keys are: {}".format(idx,s))
+
+    def get_projection_for(self, rdict, fields):
+        """ (field, value) pairs of fields in the matching dict of rdict
+
+        memoized per index values and fields, so every distinct product is looked up and projected
+        once per lookup, and the same tuple is shared by all rows and reports asking for it
+        :param fields: tuple of field names
+        """
+        key = (tuple(rdict[k] for k in self.fields_in_index), fields)
+        try:
+            return self.projections[key]
+        except KeyError:
+            match = self.get_matching_dict_for(rdict)
+            projection = self.projections[key] = tuple((k, match[k]) for k in fields)
+            return projection
+
+
+class LookupDict(LookupBase, dict):
     def __init__(self,list_of_dicts, fields_in_index):
         super(LookupDict, self).__init__()
         self.fields_in_index=fields_in_index
         self.fields=list_of_dicts[0].keys()
+        self.projections = {}
         assert set(fields_in_index).issubset(self.fields)
         for rowdict in list_of_dicts:
             index_str = self.create_index_string(rowdict)
             self[index_str]=rowdict
 
-    def create_index_string(self, rdict):
-        index_values = [rdict[key] for key in self.fields_in_index]
-        index_string = "_".join(map(str, index_values))
-        return index_string
-
     def get_matching_dict_for(self, rdict):
         idx = self.create_index_string(rdict)
         try:
-            return self[self.create_index_string(rdict)]
+            return self[idx]
         except KeyError as e:
-            similar=get_similar_strings(idx, self.keys())
-            s=[]
-            for x in similar:
-                s.append(x[0][:len(x[1])]+"<-similar_to_here,diffrent->"+x[0][len(x[1]):])
-            raise LookupKeyError("unable to lookup key '{}', the similar (but different) keys are: {}".format(idx,s))
-
+            raise self.lookup_key_error(idx)
 
 
 class SimpleSchemaValidator(object):
@@ -125,9 +446,8 @@ class SimpleSchemaValidator(object):
         self.schema = schema
         self.is_table_context = False
         self.grouped_info = {}
-        self.grouped_rows=[]
         self._current_group_context = None
-        self.primary_keys = []
+        self.primary_keys = set()
 
     def validate(self, data_dict, post_process=False):
         if "primary_keys" in self.schema:
@@ -158,54 +478,63 @@ class SimpleSchemaValidator(object):
                 #raise PrimaryKeyError("key_should_not_end_with_hidden_chars: {}".format(data_dict[key]))
 
         if self.is_table_context:
-            pk_vector = [data_dict[k] for k in self.schema["primary_keys"]]
-            if pk_vector in self.primary_keys:
-                raise PrimaryKeyError("duplicate_primary_key {}".format(pk_vector))
-            else:
-                self.primary_keys.append(pk_vector)
+            self.check_duplicate_primary_key(data_dict)
+
+    def check_duplicate_primary_key(self, data_dict):
+        pk_vector = tuple(data_dict[k] for k in self.schema["primary_keys"])
+        if pk_vector in self.primary_keys:
+            raise PrimaryKeyError("duplicate_primary_key {}".format(list(pk_vector)))
+        self.primary_keys.add(pk_vector)
 
     def fill_missing(self, data_dict):
         assert isinstance(data_dict, dict)
-        new_data = copy.deepcopy(data_dict)
+        new_data = data_dict
         for missing_defs in self.schema["fill_missing"]:
             target_field, from_fields = missing_defs["field"], missing_defs["from"]
             if not new_data[target_field]:
                 try:
-                    new_data[target_field] = next(data_dict[key] for key in from_fields if data_dict[key])
+                    value = next(data_dict[key] for key in from_fields if data_dict[key])
                 except StopIteration as e:
-                    pass
+                    continue
+                if new_data is data_dict:
+                    # row values are scalars, a shallow copy of the rows that are filled keeps the source unchanged
+                    new_data = type(data_dict)(data_dict)
+                new_data[target_field] = value
         return new_data
 
-    def populate_cached_rows_with_group_data(self):
-        for rowd in self.grouped_rows:
-            rowd.update(self.grouped_info[self._current_group_context])
-
     def generate_grouped_data(self, rowdict):
-        """ while in grouping context update grouped info, retaining grouping rows
-            after grouping context changes, update all cached rows
+        """ first pass of fill_grouped: collect the group data of every group key, in any row order
+
+            only the group data is kept, O(groups) memory, rows are filled by populate_grouped_data.
+            rows of a group have to be contiguous unless the schema sets fill_grouped "contiguous": False
         :param rowdict:
         :return:
         """
-        #import pdb;pdb.set_trace()
         grouped_field_name = self.schema["fill_grouped"]["on"]
         group_key = rowdict[grouped_field_name]
         by_field_names = self.schema["fill_grouped"]["by"]
 
-        if self._current_group_context == group_key: #inside grouping context
-            for k in by_field_names:
-                if rowdict[k]:
-                    self.grouped_info[group_key][k]=rowdict[k]
-
-            #self.grouped_info[group_key] = {k: rowdict[k] for k in by_field_names if rowdict[k] is not None}
-            self.grouped_rows.append(rowdict)
-        else:
-            if group_key in self.grouped_info:
-                raise GroupingError("{} was already grouped once".format(group_key))
-            else: #grouping context changes
-                self.populate_cached_rows_with_group_data()
-                self._current_group_context = group_key
+        if self._current_group_context != group_key: #grouping context changes
+            self._current_group_context = group_key
+            if group_key not in self.grouped_info:
                 self.grouped_info[group_key] = {k: rowdict[k] for k in by_field_names if rowdict[k] is not None}
-                self.grouped_rows=[rowdict]
+                return
+            if self.schema["fill_grouped"].get("contiguous", True):
+                raise GroupingError("{} was already grouped once".format(group_key))
+        # inside grouping context, or back in a non contiguous group
+        group_info = self.grouped_info[group_key]
+        for k in by_field_names:
+            if rowdict[k]:
+                group_info[k]=rowdict[k]
+
+    def populate_grouped_data(self, list_of_dicts):
+        """ second pass of fill_grouped: a single update per row from the shared group data """
+        grouped_field_name = self.schema["fill_grouped"]["on"]
+        grouped_info = self.grouped_info
+        for rowd in list_of_dicts:
+            group_info = grouped_info.get(rowd[grouped_field_name])
+            if group_info:
+                rowd.update(group_info)
 
     @contextlib.contextmanager
     def table_context(self):
@@ -213,28 +542,49 @@ class SimpleSchemaValidator(object):
             self.grouped_info = {}
             self.is_table_context = True
             self._current_group_context = None
-            self.primary_keys = []
+            self.primary_keys = set()
             yield
         finally:
-            if "fill_grouped" in self.schema:
-                self.populate_cached_rows_with_group_data()
             self.is_table_context = False
 
-    def validate_table(self, list_of_dicts, post_process=False):
+    def validate_table(self, list_of_dicts, post_process=False, progress=None):
+        """
+        :param progress: callable(stage, rows done, total), see iter_progress
+        """
         list_of_dicts_result=[]
         with self.table_context():
-            for i,rowdict in enumerate(list_of_dicts):
-                row = i + 1
-                with exception_context_extra_info("error in row {}".format(row), "row=<{}>".format(rowdict)):
-                    _logger.debug("processing row {}".format(row))
+            total = len(list_of_dicts) if hasattr(list_of_dicts, "__len__") else None
+            rows = iter_progress(list_of_dicts, progress,
+                                 "validating '{}'".format(self.schema.get("description", "table")), total)
+            for i, rowdict in enumerate(rows):
+                # the row is only formatted when it failed
+                with exception_context_extra_info("error in row {}".format(i + 1),
+                                                  lambda: "row=<{}>".format(rowdict)):
+                    _logger.debug("processing row %s", i + 1)
                     processed_rowdict = self.validate(rowdict, post_process=post_process)
                     if post_process:
                         if "fill_grouped" in self.schema:
                             self.generate_grouped_data(processed_rowdict)
                     list_of_dicts_result.append(processed_rowdict)
+            if post_process and "fill_grouped" in self.schema:
+                self.populate_grouped_data(list_of_dicts_result)
         return list_of_dicts_result
 
-    def export_fields(self, list_of_dicts, lookup_dict=None):
+    def iter_validate_table(self, rows):
+        """ validate_table of schemas without fill_grouped, one row at a time so rows can be streamed """
+        assert "fill_grouped" not in self.schema, "fill_grouped needs the whole table"
+        with self.table_context():
+            for i, rowdict in enumerate(rows):
+                with exception_context_extra_info("error in row {}".format(i + 1),
+                                                  lambda: "row=<{}>".format(rowdict)):
+                    yield self.validate(rowdict)
+
+    def export_fields(self, list_of_dicts, lookup_dict=None, partition=None, progress=None):
+        """ report rows of list_of_dicts matching the schema match_row_key/match_row_value
+
+        :param partition: PartitionIndex of list_of_dicts on match_row_key, only the matching rows are visited
+        :param progress: callable(stage, rows done, total), see iter_progress
+        """
         local_fields = [f for f in self.schema["report_fields"] if f in list_of_dicts[0].keys()]
 
         if "new_fields" in self.schema:
@@ -243,15 +593,22 @@ class SimpleSchemaValidator(object):
             new_fields = []
 
         if lookup_dict:
-            assert isinstance(lookup_dict, LookupDict)
-            expected_looked_up_fields = set(self.schema["report_fields"])-set(new_fields)-set(local_fields)
+            assert isinstance(lookup_dict, LookupBase)
+            expected_looked_up_fields = tuple(sorted(set(self.schema["report_fields"])-set(new_fields)-set(local_fields)))
             diff = set(expected_looked_up_fields)-set(lookup_dict.fields)
             assert not diff, "lookup dict missing keys {}".format(diff)
 
         report_table = []
         match_row_key = self.schema["match_row_key"]
         match_row_value = self.schema["match_row_value"]
-        for i, rowdict in enumerate(list_of_dicts):
+        if partition is not None:
+            assert partition.key == match_row_key, "partition on {} for a report on {}".format(partition.key,
+                                                                                             match_row_key)
+            positions = partition.get(match_row_value, [])
+        else:
+            positions = range(len(list_of_dicts))
+        for i in iter_progress(positions, progress, "exporting '{}'".format(match_row_value), len(positions)):
+            rowdict = list_of_dicts[i]
             _logger.debug("processing row {}".format(i+1))
             with exception_context_extra_info("error in row {}".format(i+1)):
                 if match_row_key in rowdict:
@@ -262,8 +619,7 @@ class SimpleSchemaValidator(object):
                         report_row.update({k:None for k in new_fields})
                         if lookup_dict:
                             # add lookup fields
-                            match = lookup_dict.get_matching_dict_for(rowdict)
-                            report_row.update({k:match[k] for k in expected_looked_up_fields})
+                            report_row.update(lookup_dict.get_projection_for(rowdict, expected_looked_up_fields))
 
                         report_table.append(report_row)
 
@@ -272,27 +628,123 @@ class SimpleSchemaValidator(object):
         return report_table
 
 
+class PartitionIndex(dict):
+    """ value of key -> positions of the rows of list_of_dicts holding it, built in one pass """
+    def __init__(self, list_of_dicts, key):
+        super(PartitionIndex, self).__init__()
+        self.key = key
+        for i, rowdict in enumerate(list_of_dicts):
+            if key in rowdict:
+                self.setdefault(rowdict[key], []).append(i)
+
+
+def get_unmatched_partitions(partitions, schemas):
+    """ :return: {(key, value): row count} of the partitioned rows no report schema covers """
+    matched = set((schema["match_row_key"], schema["match_row_value"]) for schema in schemas)
+    return OrderedDict(((key, value), len(positions)) for key, partition in partitions.items()
+                       for value, positions in sorted(partition.items()) if (key, value) not in matched)
+
+
 class CsvReport(dict):
+    extension = "csv"
+
     def __repr__(self):
         return "<Report for schema:{}>".format(self.schema["description"])
 
-    def __init__(self, schema, file=None, prefix=None):
+    def __init__(self, schema, file=None, prefix=None, row_offsets=None):
         super(CsvReport,self).__init__()
         self.schema = schema
         self.file = file
         self.prefix = prefix
+        self.row_offsets = row_offsets
 
-    def save(self, directory):
+    def save(self, directory, sidecars=False):
+        """ :param sidecars: also save the row index of the viewer and, with conf precompress_reports, the .gz
+                             sibling, both only served by the web api
+        """
         report_path = os.path.join(directory, self.get_report_file_name())
         _logger.info("saving {}".format(report_path))
-        with open(report_path, "w") as f:
+        with atomic_write(report_path) as f:
             f.write(self.file.getvalue())
+        if not sidecars:
+            return
+        if self.row_offsets is not None:
+            write_row_index(report_path + ".idx", self.row_offsets)
+        if g.config.root.precompress_reports:
+            write_gzip_sibling(report_path)
 
     def get_report_file_name(self):
-        report_filename = self.schema["match_row_value"].replace(" ", "_")
+        # a vendor such as "A/B Prints" is not a path
+        report_filename = re.sub(r"[ /\\]", "_", self.schema["match_row_value"])
         if self.prefix:
-            report_filename = "{}-{}.csv".format(self.prefix, report_filename)
-        return report_filename
+            report_filename = "{}-{}".format(self.prefix, report_filename)
+        return "{}.{}".format(report_filename, self.extension)
+
+
+def get_sheet_title(value):
+    """ excel sheet title of value: at most 31 characters, none of \\ / ? * : [ ] """
+    return re.sub(r"[\\/?*:\[\]]", "_", u"{}".format(value))[:31].strip("'") or "report"
+
+
+class XlsxReport(CsvReport):
+    """ report rows saved as an xlsx workbook
+
+    the workbook is only built on save, in openpyxl write-only mode which streams rows to the
+    sheet file as they are appended, so memory stays flat however many rows a supplier gets
+    """
+    extension = "xlsx"
+
+    def __init__(self, schema, rows, field_order, prefix=None):
+        super(XlsxReport, self).__init__(schema, prefix=prefix)
+        self.rows = rows
+        self.field_order = field_order
+
+    def save(self, directory, sidecars=False):
+        """ :param sidecars: ignored, workbooks are already compressed and have no row index """
+        from openpyxl import Workbook
+        report_path = os.path.join(directory, self.get_report_file_name())
+        _logger.info("saving {}".format(report_path))
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet(title=get_sheet_title(self.schema["match_row_value"]))
+        ws.append(self.field_order)
+        for rowdict in self.rows:
+            ws.append([rowdict.get(field) for field in self.field_order])
+        with atomic_write(report_path) as f:
+            wb.save(f)
+
+
+# row offset index saved next to a report as <report>.idx: the byte offset of every data row followed by
+# the end of the last row, as little endian uint64, so rows [start, stop) are read with two seeks
+ROW_INDEX_ITEM = struct.Struct("<Q")
+
+
+def write_row_index(index_path, row_offsets):
+    with atomic_write(index_path) as f:
+        f.write(struct.pack("<{}Q".format(len(row_offsets)), *row_offsets))
+
+
+def read_row_offsets(index_file, start, count):
+    index_file.seek(start * ROW_INDEX_ITEM.size)
+    return struct.unpack("<{}Q".format(count), index_file.read(count * ROW_INDEX_ITEM.size))
+
+
+def read_csv_rows(report_path, start, stop):
+    """ read rows [start, stop) of a saved report through its row offset index
+
+    :return: header, rows, total row count
+    """
+    index_path = report_path + ".idx"
+    row_count = os.path.getsize(index_path) // ROW_INDEX_ITEM.size - 1
+    start = max(0, min(start, row_count))
+    stop = max(start, min(stop, row_count))
+    with open(index_path, "rb") as index_file:
+        header_end, = read_row_offsets(index_file, 0, 1)
+        offsets = read_row_offsets(index_file, start, stop - start + 1)
+    with open(report_path, "rb") as f:
+        header = next(csv.reader(StringIO.StringIO(f.read(header_end))))
+        f.seek(offsets[0])
+        rows = list(csv.reader(StringIO.StringIO(f.read(offsets[-1] - offsets[0]))))
+    return header, rows, row_count
 
 
 class SchemaDescription(dict):
@@ -315,6 +767,8 @@ schema_export_orders = SchemaDescription({
     "description": "data schema export_orders",
     'fill_missing': [{"field":'Shipping Phone', "from":['Phone','Billing Phone']}],
     'fill_grouped': {  'on': 'Name',
+                        # exports sorted by vendor split the lines of an order
+                        'contiguous': False,
                         'by':  ["Shipping Name","Shipping Street",
                                 "Shipping Address1","Shipping Address2","Shipping Company",
                                 "Shipping City","Shipping Zip","Shipping Province","Shipping Country",
@@ -323,50 +777,124 @@ schema_export_orders = SchemaDescription({
        }
 )
 
-report_schema_mr_art_painting = SchemaDescription({
-    "description":"report schema Mr art Painting store",
-    'match_row_key':'Vendor',
-    'match_row_value':"Mr Art Painting store",
-    'report_fields':  ["Name", "Lineitem name", "Variant", "Lineitem quantity", "Product link", "Size",
-                "Frame option", "Shipping Name", "Shipping Street", "Shipping Address1",
-                "Shipping Address2", "Shipping Company", "Shipping City", "Shipping Zip",
-                "Shipping Province", "Shipping Country", "Shipping Phone"]
+#####################################################################
+# report schema registry
+
+
+class SchemaRegistry(object):
+    """ report schemas loaded from a json file (conf report_schemas_path), one per supplier
+
+    the file is validated and turned into SchemaDescriptions once, and reloaded only when its mtime
+    changes. a reload that fails validation is logged and the previous schemas are kept.
+    """
+    required_keys = {"description": basestring, "match_row_key": basestring, "match_row_value": basestring,
+                     "report_fields": list}
+    optional_keys = {"new_fields": list, "output_formats": list}
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.schemas = []
+        self.signature = None
+        self.reload()
+
+    @classmethod
+    def validate_schema(cls, i, schema_dict):
+        if not isinstance(schema_dict, dict):
+            raise SchemaError("report schema {} is not an object".format(i))
+        where = "report schema {} ({})".format(i, schema_dict.get("description"))
+        unknown = set(schema_dict) - set(cls.required_keys) - set(cls.optional_keys)
+        if unknown:
+            raise SchemaError("{} has unknown keys {}".format(where, sorted(unknown)))
+        for key, value_type in list(cls.required_keys.items()) + list(cls.optional_keys.items()):
+            if key not in schema_dict:
+                if key in cls.required_keys:
+                    raise SchemaError("{} is missing '{}'".format(where, key))
+                continue
+            if not isinstance(schema_dict[key], value_type):
+                raise SchemaError("{} '{}' should be a {}".format(where, key, value_type.__name__))
+            if value_type is list and not all(isinstance(f, basestring) for f in schema_dict[key]):
+                raise SchemaError("{} '{}' should be a list of field names".format(where, key))
+        if not schema_dict["report_fields"]:
+            raise SchemaError("{} has no report_fields".format(where))
+        unknown_formats = set(schema_dict.get("output_formats", [])) - set(REPORT_FORMATS)
+        if unknown_formats or schema_dict.get("output_formats") == []:
+            raise SchemaError("{} output_formats should be some of {}, not {}".format(
+                where, list(REPORT_FORMATS), schema_dict["output_formats"]))
+        not_reported = set(schema_dict.get("new_fields", [])) - set(schema_dict["report_fields"])
+        if not_reported:
+            raise SchemaError("{} new_fields {} are not in report_fields".format(where, sorted(not_reported)))
+
+    def load(self):
+        with open(self.path, "rb") as f:
+            content = f.read()
+        try:
+            data = json.loads(content, object_pairs_hook=OrderedDict)
+        except ValueError as e:
+            raise SchemaError("invalid json in {}: {}".format(self.path, e))
+        if not isinstance(data, dict) or not isinstance(data.get("report_schemas"), list):
+            raise SchemaError("{} should hold a 'report_schemas' list".format(self.path))
+        schemas = []
+        matches = set()
+        for i, schema_dict in enumerate(data["report_schemas"]):
+            self.validate_schema(i, schema_dict)
+            match = (schema_dict["match_row_key"], schema_dict["match_row_value"])
+            if match in matches:
+                raise SchemaError("more than one report schema for {}={}".format(*match))
+            matches.add(match)
+            schemas.append(SchemaDescription(schema_dict))
+        return schemas, hashlib.sha1(content).hexdigest()
+
+    def reload(self):
+        mtime = os.path.getmtime(self.path)
+        try:
+            self.schemas, self.signature = self.load()
+        except SchemaError:
+            if self.mtime is None:
+                raise
+            _logger.exception("keeping the previous report schemas, failed reloading {}".format(self.path))
+        else:
+            _logger.info("loaded {} report schemas from {}".format(len(self.schemas), self.path))
+        self.mtime = mtime
 
+    def get_report_schemas(self):
+        if os.path.getmtime(self.path) != self.mtime:
+            self.reload()
+        return self.schemas
 
-})
 
-report_schema_mr_zhen = SchemaDescription({
-    "description":"report schema mr Zhen",
-    'match_row_key': 'Vendor',
-    'match_row_value': "Zhen",
-    'report_fields':  ["Name", "Lineitem name", "Created at", "Financial status", "Fulfillment Status", "Internal note", "Marketplace",
-                "Supplier", "Product link", "Lineitem sku", "Variant", "Size", "Color", "Lineitem quantity",
-                "Price", "Shipping Name", "Shipping Street", "Shipping Address1","Tracking Number",
-                "Shipping Address2", "Shipping Company", "Shipping City", "Shipping Zip", "Shipping Province", 
-                "Shipping Country", "Shipping Phone"],
-    'new_fields': ["Financial status","Internal note","Marketplace","Supplier","Tracking Number","Price"]
-})
+_schema_registries = {}
 
 
+def get_schema_registry():
+    path = g.config.root.report_schemas_path
+    if path not in _schema_registries:
+        _schema_registries[path] = SchemaRegistry(path)
+    return _schema_registries[path]
 
 
 #####################################################################
 
 
-def import_product_list(file_path):
-    sheet="Product list"
-    table_data = read_xlsx_sheet(file_path, sheet)
+def import_product_list(source, guard=None, progress=None):
+    sheet=PRODUCT_LIST_SHEET
+    table_data = read_sheet(source, sheet, progress) if guard is None else guard.track(source.iter_sheet(sheet),
+                                                                                       sheet)
     sv = SimpleSchemaValidator(schema_product_list)
     _logger.info("validating '{}'".format(sheet))
-    return sv.validate_table(table_data)
+    return sv.validate_table(table_data, progress=progress)
 
 
-def import_export_orders(file_path):
-    sheet="Export orders"
-    table_data = read_xlsx_sheet(file_path, sheet)
+def import_export_orders(source, guard=None, progress=None):
+    """ :param guard: MemoryGuard, the sheet is then streamed row by row instead of loading the workbook
+        :param progress: callable(stage, rows done, total) of reading and validating the sheet
+    """
+    sheet=EXPORT_ORDERS_SHEET
+    table_data = read_sheet(source, sheet, progress) if guard is None else guard.track(source.iter_sheet(sheet),
+                                                                                       sheet)
     sv = SimpleSchemaValidator(schema_export_orders)
     _logger.info("validating '{}'".format(sheet))
-    return sv.validate_table(table_data,post_process=True)
+    return sv.validate_table(table_data,post_process=True, progress=progress)
 
 
 def get_csv_report(list_of_dicts, field_order):
@@ -375,8 +903,24 @@ def get_csv_report(list_of_dicts, field_order):
     file = StringIO.StringIO()
     dict_writer = csv.DictWriter(file, field_order)
     dict_writer.writeheader()
-    dict_writer.writerows(list_of_dicts)
-    return file
+    row_offsets = []
+    for rowdict in list_of_dicts:
+        row_offsets.append(file.tell())
+        dict_writer.writerow(rowdict)
+    row_offsets.append(file.tell())
+    return file, row_offsets
+
+
+REPORT_FORMATS = ("csv", "xlsx")
+
+
+def get_report(schema, report_lod, prefix, output_format="csv"):
+    field_order = schema["report_fields"]
+    if output_format == "xlsx":
+        return XlsxReport(schema, report_lod, field_order, prefix=prefix)
+    report_file, row_offsets = get_csv_report(report_lod, field_order)
+    _logger.info("generated filestorage csv report")
+    return CsvReport(schema, report_file, prefix=prefix, row_offsets=row_offsets)
 
 
 def get_file_name(filepath):
@@ -385,31 +929,360 @@ def get_file_name(filepath):
     return file_name
 
 
-def gen_reports(filepath_or_filestorage):
-    if isinstance(filepath_or_filestorage, FileStorage):
-        import_export_orders_file_name = filepath_or_filestorage.filename
+def get_source_name(source):
+    if is_file_storage(source):
+        return get_file_name(source.filename)
+    elif isinstance(source, basestring):
+        # "exports/" as completed by the shell names the directory
+        return get_file_name(os.path.normpath(source))
+    elif getattr(source, "name", None):
+        return get_file_name(source.name)
     else:
-        import_export_orders_file_name = get_file_name(filepath_or_filestorage)
+        return "report"
+
+
+def get_report_schemas():
+    return get_schema_registry().get_report_schemas()
 
-    import_export_orders_lod = import_export_orders(filepath_or_filestorage)
-    product_list_lod = import_product_list(filepath_or_filestorage)
-    lookupd = LookupDict(product_list_lod, schema_product_list["primary_keys"])
-    for schema in (globals()[k] for k in globals() if k.startswith("report_schema")):
+
+def get_catalogue_signature():
+    """ identity of the imported product catalogue with the disk lookup backend, "" otherwise
+
+    an import replaces the lookup file by a rename, so its inode, mtime and size change with every import
+    """
+    if g.config.root.lookup_backend != "disk":
+        return ""
+    path = g.config.root.product_lookup_path
+    try:
+        st = os.stat(path)
+    except OSError:
+        return "{}:missing".format(path)
+    return "{}:{}:{}:{}".format(path, st.st_ino, st.st_mtime, st.st_size)
+
+
+def get_schemas_signature():
+    """ digest of every schema that shapes the reports, and of the product catalogue the disk lookup backend
+        reads them from, changes whenever report output may change
+    """
+    registry = get_schema_registry()
+    registry.get_report_schemas()
+    data_schemas = json.dumps([schema_product_list, schema_export_orders], sort_keys=True)
+    return hashlib.sha1(data_schemas + registry.signature + get_catalogue_signature()).hexdigest()
+
+
+def get_required_sheets():
+    """ with the disk lookup backend products come from the imported catalogue, not from every source """
+    if g.config.root.lookup_backend == "disk":
+        return (EXPORT_ORDERS_SHEET,)
+    return REQUIRED_SHEETS
+
+
+class MemoryGuard(object):
+    """ resource limits of a single run, see conf max_source_rows, max_source_columns and rss_budget
+
+    check_source decides before parsing whether a source is loaded or streamed, track and check_rss
+    follow the run and abort it with a ResourceLimitError before the process runs out of memory.
+    the budget is counted from the rss of the process when the guard is created at the start of the run,
+    as memory freed by earlier runs is not handed back to the os
+    """
+    check_every = 1000
+
+    def __init__(self, max_rows=0, max_columns=0, rss_budget=0, cell_bytes=0):
+        self.max_rows = max_rows
+        self.max_columns = max_columns
+        self.rss_budget = rss_budget
+        self.cell_bytes = cell_bytes
+        self.start_rss = get_rss() if rss_budget else 0
+        # sheets without dimensions, their rows are counted while they are read
+        self.unmeasured = set()
+
+    def get_used_rss(self):
+        return max(0, get_rss() - self.start_rss)
+
+    @classmethod
+    def from_config(cls):
+        root = g.config.root
+        return cls(root.max_source_rows, root.max_source_columns, root.rss_budget, root.source_cell_bytes)
+
+    def check_source(self, table_source, sheet_names):
+        """ reject sheets over the row and column limits
+
+        :return: True when the sheets are estimated to fit the rss budget only if they are streamed
+        """
+        estimate = 0
+        for sheet_name in sheet_names:
+            dimensions = table_source.sheet_dimensions(sheet_name)
+            if dimensions is None:
+                _logger.info("'{}' has no dimensions, its limits are checked while it is read".format(sheet_name))
+                self.unmeasured.add(sheet_name)
+                continue
+            rows, columns = dimensions
+            if self.max_rows and rows > self.max_rows:
+                raise ResourceLimitError("'{}' has {} rows, more than the limit of {} rows, split the export".format(
+                    sheet_name, rows, self.max_rows))
+            if self.max_columns and columns > self.max_columns:
+                raise ResourceLimitError("'{}' has {} columns, more than the limit of {} columns".format(
+                    sheet_name, columns, self.max_columns))
+            estimate += rows * columns * self.cell_bytes
+        if self.rss_budget and self.get_used_rss() + estimate > self.rss_budget:
+            _logger.warning("the source is estimated at {}MB, over the rss budget, streaming it".format(
+                estimate // 2**20))
+            return True
+        return False
+
+    def check_rss(self, stage):
+        if not self.rss_budget:
+            return
+        rss = self.get_used_rss()
+        if rss > self.rss_budget:
+            raise ResourceLimitError("out of memory budget while {}: {}MB used of {}MB, the source is too "
+                                     "large, split the export".format(stage, rss // 2**20, self.rss_budget // 2**20))
+
+    def track(self, rows, sheet_name):
+        """ streamed rows of a sheet, counted against max_rows with the rss checked every check_every rows """
+        for i, rowdict in enumerate(rows):
+            if i == 0 and self.max_columns and len(rowdict) > self.max_columns:
+                raise ResourceLimitError("'{}' has {} columns, more than the limit of {} columns".format(
+                    sheet_name, len(rowdict), self.max_columns))
+            if self.max_rows and i >= self.max_rows:
+                raise ResourceLimitError("'{}' has more than the limit of {} rows, split the export".format(
+                    sheet_name, self.max_rows))
+            if i % self.check_every == 0:
+                self.check_rss("reading '{}'".format(sheet_name))
+            yield rowdict
+
+
+def load_source_tables(source, guard=None, low_memory=True, progress=None):
+    """ :param guard: MemoryGuard, defaults to the conf limits
+        :param low_memory: allow streaming sources that do not fit the rss budget, their product list is then
+                           returned as a DiskLookupDict of the streamed sheet
+        :param progress: callable(stage, rows done, total), see iter_progress
+        :return: validated export orders rows and product list rows of the source, see open_table_source.
+                 product list rows are None with the disk lookup backend, the sheet is not read
+    """
+    guard = guard or MemoryGuard.from_config()
+    table_source = open_table_source(source)
+    sheet_names = get_required_sheets()
+    check_source_sheets(table_source, sheet_names)
+    if guard.check_source(table_source, sheet_names) and low_memory:
+        _logger.warning("low memory mode for {}".format(get_source_name(source)))
+        import_export_orders_lod = import_export_orders(table_source, guard, progress)
+        guard.check_rss("validating '{}'".format(EXPORT_ORDERS_SHEET))
+        if g.config.root.lookup_backend == "disk":
+            return import_export_orders_lod, None
+        return import_export_orders_lod, open_streamed_product_lookup(table_source, guard)
+    import_export_orders_lod = import_export_orders(
+        table_source, guard if EXPORT_ORDERS_SHEET in guard.unmeasured else None, progress)
+    guard.check_rss("loading '{}'".format(EXPORT_ORDERS_SHEET))
+    if g.config.root.lookup_backend == "disk":
+        return import_export_orders_lod, None
+    product_list_lod = import_product_list(table_source, guard if PRODUCT_LIST_SHEET in guard.unmeasured else None,
+                                           progress)
+    guard.check_rss("loading '{}'".format(PRODUCT_LIST_SHEET))
+    return import_export_orders_lod, product_list_lod
+
+
+def open_streamed_product_lookup(table_source, guard):
+    """ DiskLookupDict of the product list of table_source, streamed into an unlinked temporary file """
+    import tempfile, shutil
+    from disk_lookup import build_disk_lookup, DiskLookupDict
+    sv = SimpleSchemaValidator(schema_product_list)
+    rows = sv.iter_validate_table(guard.track(table_source.iter_sheet(PRODUCT_LIST_SHEET), PRODUCT_LIST_SHEET))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # the mapping stays valid once the file is removed
+        return DiskLookupDict(build_disk_lookup(os.path.join(tmp_dir, "products.lookup"), rows,
+                                                schema_product_list["primary_keys"]))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def iter_product_list(source):
+    """ validated product list rows of source, streamed one row at a time """
+    table_source = open_table_source(source)
+    check_source_sheets(table_source, [PRODUCT_LIST_SHEET])
+    sv = SimpleSchemaValidator(schema_product_list)
+    return sv.iter_validate_table(table_source.iter_sheet(PRODUCT_LIST_SHEET))
+
+
+def import_product_catalogue(source, path=None):
+    """ build the product lookup file of the disk lookup backend from the product list of source
+
+    the sheet is streamed into the file, so a catalogue of any size is imported without holding its rows
+    :param path: defaults to conf product_lookup_path
+    """
+    from disk_lookup import build_disk_lookup
+    path = path or g.config.root.product_lookup_path
+    _logger.info("importing the product catalogue of {} to {}".format(get_source_name(source), path))
+    return build_disk_lookup(path, iter_product_list(source), schema_product_list["primary_keys"])
+
+
+def get_product_lookup(product_list_lod):
+    """ LookupDict of the product list, or with conf lookup_backend "disk" the DiskLookupDict of the
+        catalogue at conf product_lookup_path, shared read only by every worker process
+    """
+    if isinstance(product_list_lod, LookupBase):
+        return product_list_lod
+    if g.config.root.lookup_backend == "disk":
+        from disk_lookup import DiskLookupDict
+        path = g.config.root.product_lookup_path
+        if not os.path.isfile(path):
+            raise IOError("no product catalogue at '{}', import one with --import-catalogue".format(path))
+        return DiskLookupDict(path)
+    return LookupDict(product_list_lod, schema_product_list["primary_keys"])
+
+
+def iter_reports(import_export_orders_lod, product_list_lod, prefix, progress=None, guard=None):
+    lookupd = get_product_lookup(product_list_lod)
+    try:
+        for report in iter_lookup_reports(import_export_orders_lod, lookupd, prefix, progress, guard):
+            yield report
+    finally:
+        if hasattr(lookupd, "close"):
+            lookupd.close()
+
+
+def iter_lookup_reports(import_export_orders_lod, lookupd, prefix, progress=None, guard=None):
+    """ :param guard: MemoryGuard of the run, defaults to the conf limits counted from here """
+    guard = guard or MemoryGuard.from_config()
+    schemas = get_report_schemas()
+    # one pass over the orders per match key (Vendor), each report then visits only its own rows
+    partitions = dict((key, PartitionIndex(import_export_orders_lod, key))
+                      for key in set(schema["match_row_key"] for schema in schemas))
+    unmatched = get_unmatched_partitions(partitions, schemas)
+    if unmatched:
+        _logger.warning("rows without a report schema: {}".format(
+            ", ".join("{}={!r}: {}".format(key, value, count) for (key, value), count in unmatched.items())))
+    for schema in schemas:
         _logger.info("processing data for report: {}".format(schema))
         sv = SimpleSchemaValidator(schema)
         try:
-            report_lod = sv.export_fields(import_export_orders_lod, lookupd)
+            report_lod = sv.export_fields(import_export_orders_lod, lookupd, partitions[schema["match_row_key"]],
+                                          progress)
         except LookupKeyError as e:
             _logger.error("unable to locate product list key")
             raise
-        if report_lod:
-            field_order = schema["report_fields"]
-            report_file = get_csv_report(report_lod, field_order)
-            _logger.info("generated filestorage csv report")
-            report = CsvReport(schema, report_file, prefix=import_export_orders_file_name)
-        else:
-            report = None
+        guard.check_rss("generating the report for {}".format(schema["match_row_value"]))
+        if not report_lod:
+            yield None
+            continue
+        for output_format in schema.get("output_formats", ["csv"]):
+            yield get_report(schema, report_lod, prefix, output_format)
+
+
+def gen_reports(source, name=None, progress=None):
+    """ generate a report per report schema
+
+    :param source: file path, FileStorage, file object or mmap buffer of the export workbook or of a zip of
+                   csv sheets, or a directory of csv sheets. a workbook is loaded once and shared by all sheets
+    :param name: reports prefix, defaults to the source file name
+    :param progress: callable(stage, rows done, total) called while the sheets are read and validated and
+                     while each report is exported, total is None when it is not known in advance
+    :return: generator of CsvReport (an XlsxReport per schema listing xlsx in its output_formats),
+             None for schemas without data
+    """
+    import_export_orders_file_name = name or get_source_name(source)
+
+    # the rss budget of the run is counted from here
+    guard = MemoryGuard.from_config()
+    import_export_orders_lod, product_list_lod = load_source_tables(source, guard, progress=progress)
+    store_source_tables(import_export_orders_file_name, import_export_orders_lod, product_list_lod)
+    for report in iter_reports(import_export_orders_lod, product_list_lod, import_export_orders_file_name,
+                               progress, guard):
+        yield report
 
+
+def store_source_tables(source_name, import_export_orders_lod, product_list_lod):
+    """ keep the validated rows in the order store, when conf order_store_path is set """
+    if not g.config.root.order_store_path:
+        return None
+    if isinstance(product_list_lod, LookupBase):
+        # a streamed product list is not kept in memory to store
+        product_list_lod = None
+    from order_store import order_store_context
+    with order_store_context(g.config.root.order_store_path) as store:
+        return store.ingest(source_name, import_export_orders_lod, product_list_lod)
+
+
+def gen_store_reports(store_path, name="store", vendor=None, since=None):
+    """ generate reports from the order store instead of a source workbook
+
+    :param vendor: only orders of this vendor
+    :param since: date or datetime, only orders created on or after its day
+    :return: generator of CsvReport, as gen_reports
+    """
+    from order_store import order_store_context
+    with order_store_context(store_path) as store:
+        import_export_orders_lod = store.get_orders(vendor=vendor, since=since)
+        product_list_lod = store.get_products() if g.config.root.lookup_backend != "disk" else None
+    _logger.info("loaded {} orders rows and {} product rows from {}".format(
+        len(import_export_orders_lod), len(product_list_lod or []), store_path))
+    if not import_export_orders_lod:
+        _logger.warning("no stored orders for vendor={} since={}".format(vendor, since))
+        return
+    for report in iter_reports(import_export_orders_lod, product_list_lod, name):
+        yield report
+
+
+def merge_source_tables(source_tables):
+    """ combine the tables of several export workbooks into one orders table and one product list
+
+    an order (fill_grouped "on" value) has to come from a single workbook. product list rows are
+    deduplicated on the product list primary keys, a key with different rows in two workbooks is an error.
+    :param source_tables: list of (source name, export orders rows, product list rows)
+    :return: export orders rows, product list rows
+    """
+    order_field = schema_export_orders["fill_grouped"]["on"]
+    product_keys = schema_product_list["primary_keys"]
+    order_sources = {}
+    products = OrderedDict()
+    product_sources = {}
+    orders_lod = []
+    for source_name, source_orders_lod, source_product_list_lod in source_tables:
+        for rowdict in source_orders_lod:
+            first_source = order_sources.setdefault(rowdict[order_field], source_name)
+            if first_source != source_name:
+                raise GroupingError("{} {} is in both {} and {}".format(order_field, rowdict[order_field],
+                                                                        first_source, source_name))
+        orders_lod.extend(source_orders_lod)
+        for rowdict in source_product_list_lod or []:
+            pk_vector = tuple(rowdict[k] for k in product_keys)
+            if pk_vector not in products:
+                products[pk_vector] = rowdict
+                product_sources[pk_vector] = source_name
+            # rows are OrderedDicts, sources with the same columns in another order agree
+            elif dict(products[pk_vector]) != dict(rowdict):
+                raise PrimaryKeyError("duplicate_primary_key {} differs between {} and {}".format(
+                    list(pk_vector), product_sources[pk_vector], source_name))
+    return orders_lod, list(products.values())
+
+
+def gen_merged_reports(sources, name="merged", jobs=1):
+    """ one report per report schema over several export workbooks, e.g. one per storefront
+
+    :param sources: file paths of the export workbooks, parsed and validated in parallel
+    :param name: reports prefix
+    :param jobs: worker processes parsing the workbooks
+    :return: generator of CsvReport (an XlsxReport per schema listing xlsx in its output_formats),
+             None for schemas without data
+    """
+    if jobs > 1 and len(sources) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes=min(jobs, len(sources)))
+        try:
+            # a streamed product lookup can not be sent back from a worker, merged sources are loaded
+            tables = pool.map(functools.partial(load_source_tables, low_memory=False), sources, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        tables = [load_source_tables(source, low_memory=False) for source in sources]
+    _logger.info("merging {} workbooks".format(len(sources)))
+    import_export_orders_lod, product_list_lod = merge_source_tables(
+        [(get_source_name(source), orders_lod, product_list_lod)
+         for source, (orders_lod, product_list_lod) in zip(sources, tables)])
+    store_source_tables(name, import_export_orders_lod, product_list_lod)
+    for report in iter_reports(import_export_orders_lod, product_list_lod, name):
         yield report
 
 
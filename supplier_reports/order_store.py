@@ -0,0 +1,140 @@
+"""
+optional local sqlite store of validated export orders and product list rows (conf order_store_path)
+
+every imported source is recorded in imports, its rows are kept as json next to the indexed columns
+reports query on: (vendor, lineitem_name) for product lookups and vendor reports, name for orders and
+created_at for date ranges. a later import of an order replaces its earlier rows, and the product list
+row of the latest import wins, so reports can be generated again without reparsing any workbook.
+"""
+
+import json
+import time
+import sqlite3
+import logging
+import contextlib
+from collections import OrderedDict
+
+_logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS imports (
+    import_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    source_name TEXT NOT NULL,
+    imported_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS orders (
+    import_id INTEGER NOT NULL REFERENCES imports(import_id),
+    row_number INTEGER NOT NULL,
+    name TEXT,
+    vendor TEXT,
+    lineitem_name TEXT,
+    created_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS products (
+    import_id INTEGER NOT NULL REFERENCES imports(import_id),
+    vendor TEXT NOT NULL,
+    lineitem_name TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS orders_vendor_lineitem ON orders (vendor, lineitem_name);
+CREATE INDEX IF NOT EXISTS orders_name ON orders (name);
+CREATE INDEX IF NOT EXISTS orders_created_at ON orders (created_at);
+CREATE INDEX IF NOT EXISTS products_vendor_lineitem ON products (vendor, lineitem_name, import_id);
+"""
+
+# "Created at" is compared as text, shopify writes it as "2018-02-14 10:23:45 -0500"
+CREATED_AT_FORMAT = "%Y-%m-%d"
+
+
+def to_text(value):
+    """ datetimes and numbers as the csv reports write them """
+    if value is None or isinstance(value, basestring):
+        return value
+    return u"{}".format(value)
+
+
+def dump_row(rowdict):
+    """ json keeps numbers, other values such as datetimes are kept as text """
+    return json.dumps(list(rowdict.items()), default=to_text)
+
+
+def load_row(data):
+    return OrderedDict(json.loads(data))
+
+
+class OrderStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def ingest(self, source_name, orders, products):
+        """ bulk insert the rows of one source in a single transaction
+
+        :param products: product list rows, None when the source has none (disk lookup backend)
+
+        :return: import_id
+        """
+        start = time.time()
+        with self.connection:
+            cursor = self.connection.execute("INSERT INTO imports (source_name, imported_at) VALUES (?, ?)",
+                                             (source_name, time.time()))
+            import_id = cursor.lastrowid
+            self.connection.executemany("DELETE FROM orders WHERE name = ?",
+                                        [(name,) for name in set(to_text(row.get("Name")) for row in orders)])
+            self.connection.executemany(
+                "INSERT INTO orders (import_id, row_number, name, vendor, lineitem_name, created_at, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((import_id, i, to_text(row.get("Name")), to_text(row.get("Vendor")), to_text(row.get("Lineitem name")),
+                  to_text(row.get("Created at")), dump_row(row)) for i, row in enumerate(orders)))
+            self.connection.executemany(
+                "INSERT INTO products (import_id, vendor, lineitem_name, data) VALUES (?, ?, ?, ?)",
+                ((import_id, to_text(row["Vendor"]), to_text(row["Lineitem name"]), dump_row(row))
+                 for row in products or []))
+        _logger.info("stored {} orders rows and {} product rows of {} as import {} in {:.2f}s".format(
+            len(orders), len(products or []), source_name, import_id, time.time() - start))
+        return import_id
+
+    def get_orders(self, vendor=None, since=None, name=None):
+        """ orders rows in import order
+
+        :param since: date or datetime, only orders created on or after its day
+        """
+        where, params = [], []
+        if vendor is not None:
+            where.append("vendor = ?")
+            params.append(vendor)
+        if name is not None:
+            where.append("name = ?")
+            params.append(name)
+        if since is not None:
+            where.append("created_at >= ?")
+            params.append(since.strftime(CREATED_AT_FORMAT))
+        query = "SELECT data FROM orders {} ORDER BY import_id, row_number".format(
+            "WHERE " + " AND ".join(where) if where else "")
+        return [load_row(data) for data, in self.connection.execute(query, params)]
+
+    def get_products(self):
+        """ product list rows, the latest imported row of every (Vendor, Lineitem name) """
+        query = ("SELECT data FROM products p WHERE import_id = (SELECT MAX(import_id) FROM products latest "
+                 "WHERE latest.vendor = p.vendor AND latest.lineitem_name = p.lineitem_name) "
+                 "ORDER BY vendor, lineitem_name")
+        return [load_row(data) for data, in self.connection.execute(query)]
+
+    def get_imports(self):
+        """ :return: list of (import_id, source_name, imported_at), latest first """
+        return self.connection.execute(
+            "SELECT import_id, source_name, imported_at FROM imports ORDER BY import_id DESC").fetchall()
+
+
+@contextlib.contextmanager
+def order_store_context(path):
+    store = OrderStore(path)
+    try:
+        yield store
+    finally:
+        store.close()
@@ -4,6 +4,7 @@ common utilities for short scripts
 
 import logging, os
 import subprocess, sys
+import time
 import inspect
 import traceback, pdb
 import functools
@@ -116,12 +117,97 @@ def full_context_error_logger():
 
 @contextmanager
 def exception_context_extra_info(*args):
+    """ append args to the args of an exception raised in the block, callables are called to format them then """
     try:
         yield
     except Exception as e:
-        e.args = tuple(list(e.args) + list(args))
+        e.args = tuple(list(e.args) + [arg() if callable(arg) else arg for arg in args])
         raise
 
+@contextmanager
+def profiling_context(stats_path, enabled=True):
+    """ run the enclosed block under cProfile and dump the stats to stats_path
+
+    the dump is sortable with: pstats.Stats(stats_path).sort_stats("cumulative").print_stats(30)
+
+    :param stats_path: where to write the profile stats
+    :param enabled: when False the block runs unprofiled
+    :return:
+    """
+    if not enabled:
+        yield None
+        return
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(stats_path)
+        _logger.info("profile stats saved to {}".format(stats_path))
+
+
+def get_umask():
+    # os.umask only reads the mask by setting it, done once as it is process wide and threads create files
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+UMASK = get_umask()
+
+
+@contextmanager
+def atomic_write(file_path, mode="wb"):
+    """ write to a temp file next to file_path and rename it over file_path when the block succeeds
+
+    readers see either the previous or the complete new file, never a partial one. the file gets the
+    permissions of a file created by open, not the 0600 of the temp file
+    """
+    import tempfile
+    directory, file_name = os.path.split(file_path)
+    fd, tmp_path = tempfile.mkstemp(prefix=".{}.".format(file_name), suffix=".tmp", dir=directory or ".")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.chmod(tmp_path, 0o666 & ~UMASK)
+        os.rename(tmp_path, file_path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_gzip_sibling(file_path, chunk_size=64*1024):
+    """ write a precompressed copy of file_path to file_path.gz, for serving with Content-Encoding: gzip
+
+    :return: the .gz path
+    """
+    import gzip, shutil
+    gz_path = file_path + ".gz"
+    with open(file_path, "rb") as src, atomic_write(gz_path) as dst:
+        gz = gzip.GzipFile(filename=os.path.basename(file_path), mode="wb", compresslevel=6, fileobj=dst)
+        try:
+            shutil.copyfileobj(src, gz, chunk_size)
+        finally:
+            gz.close()
+    return gz_path
+
+
+def get_rss():
+    """ resident set size of this process in bytes, from /proc/self/statm, or the peak rss elsewhere """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_profile_stats_path(directory, name):
+    return os.path.join(directory, "{}-{}.prof".format(name, time.strftime("%Y%m%d-%H%M%S")))
+
 ##################################################
 # other
 ##################################################
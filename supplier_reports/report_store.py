@@ -0,0 +1,153 @@
+"""
+per upload report namespaces inside reports_dir
+
+every upload gets its own reports_dir/uploads/<upload_id>/ directory, so concurrent uploads of similarly
+named files never write to the same paths. an upload is complete once its manifest.json exists, and the
+latest complete upload is published by renaming latest.json (and latest-<source name>.json) into place,
+so readers look it up without locks and never see a half written report set.
+
+uploads are kept for good unless pruned, see prune_uploads.
+"""
+
+import os
+import re
+import json
+import glob
+import time
+import shutil
+import logging
+from collections import defaultdict
+from supplier_reports.python_script_common import atomic_write, generate_random_name
+
+_logger = logging.getLogger(__name__)
+
+UPLOADS_DIR = "uploads"
+MANIFEST_FILE_NAME = "manifest.json"
+LATEST_FILE_NAME = "latest.json"
+# an upload directory without a manifest this old was abandoned by a crashed or killed run
+INCOMPLETE_UPLOAD_MAX_AGE = 24*60*60
+
+_upload_id_re = re.compile(r"^[\w-]+$")
+
+
+def new_upload_id():
+    return "{}-{}".format(time.strftime("%Y%m%d-%H%M%S"), generate_random_name(6))
+
+
+def get_upload_dir(reports_dir, upload_id):
+    if not _upload_id_re.match(upload_id):
+        raise ValueError("invalid upload id '{}'".format(upload_id))
+    return os.path.join(reports_dir, UPLOADS_DIR, upload_id)
+
+
+def create_upload_dir(reports_dir, upload_id=None):
+    """ :return: upload_id, upload directory """
+    upload_id = upload_id or new_upload_id()
+    upload_dir = get_upload_dir(reports_dir, upload_id)
+    os.makedirs(upload_dir)
+    return upload_id, upload_dir
+
+
+def get_upload_path(upload_id, file_name):
+    """ path of an upload file relative to reports_dir, as served under /reports/ """
+    return "/".join([UPLOADS_DIR, upload_id, file_name])
+
+
+def get_latest_file_name(source_name=None):
+    return "latest-{}.json".format(source_name) if source_name else LATEST_FILE_NAME
+
+
+def complete_upload(reports_dir, upload_id, source_name, report_file_names):
+    """ write the upload manifest, then publish it as the latest report set overall and for source_name """
+    manifest = dict(upload_id=upload_id, source_name=source_name, report_file_names=report_file_names,
+                    completed_at=time.time())
+    data = json.dumps(manifest, indent=2)
+    with atomic_write(os.path.join(get_upload_dir(reports_dir, upload_id), MANIFEST_FILE_NAME), "w") as f:
+        f.write(data)
+    for latest_file_name in (get_latest_file_name(), get_latest_file_name(source_name)):
+        with atomic_write(os.path.join(reports_dir, UPLOADS_DIR, latest_file_name), "w") as f:
+            f.write(data)
+    _logger.info("completed upload {} with {} reports".format(upload_id, len(report_file_names)))
+    return manifest
+
+
+def _read_json(file_path):
+    try:
+        with open(file_path) as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+
+def read_manifest(reports_dir, upload_id):
+    """ :return: manifest of a completed upload, None when it is unknown or still being written """
+    try:
+        upload_dir = get_upload_dir(reports_dir, upload_id)
+    except ValueError:
+        return None
+    return _read_json(os.path.join(upload_dir, MANIFEST_FILE_NAME))
+
+
+def get_published_upload_ids(reports_dir):
+    """ uploads referenced by latest.json or a latest-<source name>.json """
+    manifests = [_read_json(path) for path in glob.glob(os.path.join(reports_dir, UPLOADS_DIR, "latest*.json"))]
+    return set(manifest["upload_id"] for manifest in manifests if manifest)
+
+
+def remove_upload(reports_dir, upload_id):
+    """ delete an upload directory, unless it is published as a latest upload
+
+    :return: True when removed
+    """
+    if upload_id in get_published_upload_ids(reports_dir):
+        return False
+    _remove_upload_dir(reports_dir, upload_id)
+    return True
+
+
+def _remove_upload_dir(reports_dir, upload_id):
+    shutil.rmtree(get_upload_dir(reports_dir, upload_id), ignore_errors=True)
+    _logger.info("removed upload {}".format(upload_id))
+
+
+def prune_uploads(reports_dir, keep_per_source):
+    """ delete all but the keep_per_source latest completed uploads of each source, and abandoned incomplete ones
+
+    uploads published as a latest upload are never deleted, nor are incomplete ones younger than
+    INCOMPLETE_UPLOAD_MAX_AGE, they may still be generating
+
+    :return: removed upload ids
+    """
+    uploads_dir = os.path.join(reports_dir, UPLOADS_DIR)
+    if not os.path.isdir(uploads_dir):
+        return []
+    published = get_published_upload_ids(reports_dir)
+    uploads_by_source = defaultdict(list)
+    removed = []
+    for upload_id in os.listdir(uploads_dir):
+        if not _upload_id_re.match(upload_id) or not os.path.isdir(os.path.join(uploads_dir, upload_id)):
+            continue
+        manifest = read_manifest(reports_dir, upload_id)
+        if manifest is not None:
+            uploads_by_source[manifest["source_name"]].append((manifest["completed_at"], upload_id))
+        elif upload_id not in published and \
+                time.time() - os.path.getmtime(os.path.join(uploads_dir, upload_id)) > INCOMPLETE_UPLOAD_MAX_AGE:
+            removed.append(upload_id)
+    for uploads in uploads_by_source.values():
+        uploads.sort(reverse=True)
+        removed.extend(upload_id for completed_at, upload_id in uploads[keep_per_source:]
+                       if upload_id not in published)
+    for upload_id in removed:
+        _remove_upload_dir(reports_dir, upload_id)
+    return removed
+
+
+def get_upload_id(upload_path):
+    """ upload id of a path relative to reports_dir, see get_upload_path, None outside of the uploads """
+    parts = upload_path.split("/")
+    return parts[1] if len(parts) > 2 and parts[0] == UPLOADS_DIR else None
+
+
+def get_latest_manifest(reports_dir, source_name=None):
+    """ :return: manifest of the latest completed upload, of source_name when given """
+    return _read_json(os.path.join(reports_dir, UPLOADS_DIR, get_latest_file_name(source_name)))
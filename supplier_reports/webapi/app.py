@@ -1,20 +1,144 @@
 from flask import ( Flask, request, redirect, url_for,flash ,
                     request, send_from_directory, send_file, Response, session)
 from werkzeug.utils import secure_filename
+from flask.helpers import safe_join
 import os
+import mimetypes
 from supplier_reports import conf as g
-from supplier_reports.python_script_common import full_context_error_logger
-from supplier_reports.gen_reports import gen_reports
+from supplier_reports.python_script_common import (full_context_error_logger, profiling_context,
+                                                   get_profile_stats_path)
+from supplier_reports.gen_reports import (gen_reports, get_file_name, open_table_source, check_source_sheets,
+                                          get_required_sheets, ParsingError, ResourceLimitError,
+                                          get_schemas_signature, read_csv_rows)
+from supplier_reports.webapi.report_cache import ReportCache
+from supplier_reports.webapi.zipstream import iter_zip
+from supplier_reports.webapi.jobs import JobRegistry
+from supplier_reports import report_store
 import flask
 from werkzeug.debug import DebuggedApplication
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
 from functools import wraps
+import logging
+import tempfile
+import hashlib
+import shutil
+import json
+
+_logger = logging.getLogger(__name__)
+
+UPLOAD_EXTENSIONS = (".xlsx", ".zip")
+
+
+class SizeLimitedFile(object):
+    """ upload part file that refuses to grow beyond limit bytes, also when no Content-Length was sent """
+    def __init__(self, fileobj, name, limit):
+        self.fileobj = fileobj
+        self.name = name
+        self.limit = limit
+        self.size = 0
+        # content hash computed while streaming, for the report cache
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise RequestEntityTooLarge("upload is larger than {} bytes".format(self.limit))
+        self.sha256.update(data)
+        self.fileobj.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+class UploadRequest(flask.Request):
+    """ uploaded files are written to a part file in reports_dir chunk by chunk as the multipart body is
+        parsed, instead of being buffered in memory and copied on save
+    """
+    @property
+    def max_content_length(self):
+        return g.config.root.max_upload_size
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        fd, part_path = tempfile.mkstemp(prefix=".upload-", suffix=".part", dir=g.config.root.reports_dir)
+        part = SizeLimitedFile(os.fdopen(fd, "w+b"), part_path, g.config.root.max_upload_size)
+        self.upload_parts = getattr(self, "upload_parts", []) + [part]
+        return part
+
 
 app = Flask("webapi", static_url_path='')
+app.request_class = UploadRequest
+
+def remove_cached_uploads(reports_dir, upload_paths):
+    """ report cache eviction, the upload directories of the entry go with it unless they are still the latest """
+    for upload_id in set(report_store.get_upload_id(path) for path in upload_paths) - {None}:
+        report_store.remove_upload(reports_dir, upload_id)
+
+
+report_cache = ReportCache(g.config.root.report_cache_entries, g.config.root.report_cache_bytes,
+                           on_evict=remove_cached_uploads)
+
+# background report jobs, kept in the memory of one process: only enabled by serve(processes=1) and main(),
+# not under an external WSGI server that may send the events request to another worker
+app.config["JOBS_ENABLED"] = False
+jobs = JobRegistry()
+# ?profile=1 bypasses the report cache and publishes a .prof file with the reports: development server only
+app.config["PROFILING_ENABLED"] = False
 
+# upload page script of the jobs, without it the form is posted as is
+UPLOAD_JOBS_SCRIPT = """<script>
+        // post to a background job and follow its progress, the plain form post without EventSource
+        var form = document.getElementById("upload");
+        form.onsubmit = function (e) {
+            if (!window.EventSource || !window.FormData) {
+                return true;
+            }
+            e.preventDefault();
+            var status = document.getElementById("progress");
+            var xhr = new XMLHttpRequest();
+            xhr.open("POST", "/jobs" + location.search);
+            xhr.onload = function () {
+                if (xhr.status != 202) {
+                    document.body.innerHTML = xhr.responseText;
+                    return;
+                }
+                var events = new EventSource(JSON.parse(xhr.responseText).events);
+                events.addEventListener("progress", function (e) {
+                    var data = JSON.parse(e.data);
+                    status.textContent = data.stage + ": " + data.rows +
+                        (data.total === null ? "" : " of " + data.total) + " rows";
+                });
+                events.addEventListener("done", function (e) {
+                    events.close();
+                    document.body.innerHTML = JSON.parse(e.data).html;
+                });
+                events.addEventListener("failed", function (e) {
+                    events.close();
+                    status.textContent = "failed: " + JSON.parse(e.data).message;
+                });
+                // unknown job or dropped stream, an EventSource would otherwise retry without a word
+                events.onerror = function () {
+                    events.close();
+                    status.textContent = "lost the progress of the upload, see the latest reports at /uploads/latest";
+                };
+            };
+            status.textContent = "uploading";
+            xhr.send(new FormData(form));
+        };
+        </script>"""
 
-if g.config.root.debug is True:
-    app.debug = True
-    app.wsgi_app = DebuggedApplication(app.wsgi_app, evalex=True)
+
+@app.teardown_request
+def remove_upload_parts(exc=None):
+    for part in getattr(request, "upload_parts", []):
+        part.close()
+        if os.path.exists(part.name):
+            os.remove(part.name)
+
+
+def enable_debugger():
+    if not isinstance(app.wsgi_app, DebuggedApplication):
+        app.debug = True
+        app.wsgi_app = DebuggedApplication(app.wsgi_app, evalex=True)
 
 
 class HtmlPage(object):
@@ -61,37 +185,18 @@ def render_text_page(body):
     return r
 
 
-def csv_to_html_table(file_path, headers=None, delimiter=","):
-    with open(file_path) as f:
-        content = f.readlines()
-    #reading file content into list
-    rows = [x.strip() for x in content]
-    table = "<table border=1>"
-    #creating HTML header row if header is provided
-    if headers is not None:
-        table+= "\n".join(["\n\t<th>"+cell+"</th>" for cell in headers.split(delimiter)])
-    else:
-        table+= "\n".join(["\n\t<th>"+cell+"</th>" for cell in rows[0].split(delimiter)])
-        rows=rows[1:]
-    #Converting csv to html row by row
-    for row in rows:
-        table+= "\n\t<tr>" + "".join(["\n\t\t<td>"+cell+"</td>" for cell in row.split(delimiter)]) + "</tr>" + "\n"
-    table+="</table><br>"
-    return table
-
-
-def csv_to_html_file(file_path):
-    html_table=csv_to_html_table(file_path)
-    html_page = render_html_page(msgs=html_table)
-    with open(file_path + ".html","wt") as fp:
-        fp.write(html_page)
-
-
 def render_full_context_error(view_func):
     @wraps(view_func)
     def wrapper(*args, **kwargs):
+        http_error = None
         with full_context_error_logger() as result:
-            view_content = view_func(*args, **kwargs)
+            try:
+                view_content = view_func(*args, **kwargs)
+            except HTTPException as e:
+                # aborts (400, 413) are answered as such, not as an error log page
+                http_error = e
+        if http_error is not None:
+            raise http_error
         if result["error_log"]:
             return render_text_page(result["error_log"])
         else:
@@ -99,11 +204,88 @@ def render_full_context_error(view_func):
     return wrapper
 
 
+def render_upload_links(manifest):
+    upload_id = manifest["upload_id"]
+    links = []
+    for report_file_name in manifest["report_file_names"]:
+        upload_path = report_store.get_upload_path(upload_id, report_file_name)
+        # only csv reports have a row index for the viewer
+        view_link = '<a href="/view/{}">view</a>, '.format(upload_path) if report_file_name.endswith(".csv") else ""
+        links.append('{0}: {1}<a href="/reports/{2}">download</a><br>'.format(report_file_name, view_link, upload_path))
+    if manifest["report_file_names"]:
+        links.append('<a href="/uploads/{}/reports.zip">download all reports as zip</a><br>'.format(upload_id))
+    return links
+
+
+def get_upload_file_name(file):
+    if not file.filename.lower().endswith(UPLOAD_EXTENSIONS):
+        flask.abort(400, "not an excel file or a zip of csv sheets '{}".format(file.filename))
+    return secure_filename(file.filename)
+
+
+def get_upload_cache_key(file):
+    """ content hash of the upload streamed to its part file and the signature of the report schemas """
+    return "{}-{}".format(file.stream.sha256.hexdigest(), get_schemas_signature())
+
+
+def is_profile_request():
+    # per request profiling, post the form to /?profile=1 of the development server
+    return app.config["PROFILING_ENABLED"] and request.args.get("profile", default="") not in ("", "0")
+
+
+def process_upload(source, part_path, uploadfilename, cache_key, profile=False, progress=None):
+    """ generate and publish the reports of an upload, or find them in the report cache
+
+    :param source: the upload as accepted by gen_reports, parsed in place instead of saving and reparsing a copy
+    :param part_path: file the upload was streamed to, kept next to its reports
+    :param progress: callable(stage, rows done, total), see gen_reports
+    :return: html of the report links
+    :raise ParsingError: source is not an export
+    :raise ResourceLimitError: source is larger than the conf limits
+    """
+    msgs = ["<h3>generated reports</h3><br>"]
+    source_name = get_file_name(uploadfilename)
+    reports_dir = g.config.root.reports_dir
+    cached_paths = None if profile else report_cache.get(cache_key, reports_dir)
+    if cached_paths is not None:
+        _logger.info("serving {} from the report cache".format(uploadfilename))
+        manifest_path = cached_paths[0]
+        upload_id = report_store.get_upload_id(manifest_path)
+        msgs.extend(render_upload_links(report_store.read_manifest(reports_dir, upload_id)))
+        return "".join(msgs)
+    check_source_sheets(open_table_source(source), get_required_sheets())
+    # every upload writes to its own directory, published by its manifest once complete
+    upload_id, upload_dir = report_store.create_upload_dir(reports_dir)
+    stats_path = get_profile_stats_path(upload_dir, uploadfilename)
+    report_file_names = []
+    try:
+        with profiling_context(stats_path, enabled=profile):
+            csv_reports = gen_reports(source, name=source_name, progress=progress)
+            for report in csv_reports:
+                if report is not None:
+                    report_file_name=report.get_report_file_name()
+                    report.save(upload_dir, sidecars=True)
+                    report_file_names.append(report_file_name)
+        os.rename(part_path, os.path.join(upload_dir, uploadfilename))
+        manifest = report_store.complete_upload(reports_dir, upload_id, source_name, report_file_names)
+    except:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        raise
+    report_cache.put(cache_key, reports_dir, [report_store.get_upload_path(upload_id, file_name) for file_name
+                                              in [report_store.MANIFEST_FILE_NAME] + report_file_names])
+    if g.config.root.uploads_kept_per_source:
+        report_store.prune_uploads(reports_dir, g.config.root.uploads_kept_per_source)
+    msgs.extend(render_upload_links(manifest))
+    if profile:
+        msgs.append('profile: <a href="/reports/{0}">{1}</a><br>'.format(
+            report_store.get_upload_path(upload_id, os.path.basename(stats_path)), os.path.basename(stats_path)))
+    return "".join(msgs)
+
+
 @app.route('/', methods=['GET', 'POST'])
 @render_full_context_error
 def upload_file():
     if request.method == 'POST':
-        msgs = ["<h3>generated reports</h3><br>"]
         # check if the post request has the file part
         if 'file' not in request.files:
             flash('No file part')
@@ -115,24 +297,19 @@ def upload_file():
             flash('No selected file')
             return redirect(request.url)
         if file:
-            if not file.filename.endswith("xlsx"):
-                flask.abort(400, "not excel file '{}".format(file.filename))
-            uploadfilename = secure_filename(file.filename)
-            file_path = os.path.join(g.config.root.reports_dir, uploadfilename)
-            file.save(file_path)
-            csv_reports = gen_reports(file_path)
-            for report in csv_reports:
-                if report is not None:
-                    report_file_name=report.get_report_file_name()
-                    report.save(g.config.root.reports_dir)
-                    csv_to_html_file(os.path.join(g.config.root.reports_dir,report.get_report_file_name()))
-                    msgs.append('{}: '
-                                '<a href="/reports/{}.html">view</a>, '
-                                '<a href="/reports/{}">download</a><br>'.format(report_file_name, report_file_name, report_file_name))
-            return render_html_page(msgs)
+            uploadfilename = get_upload_file_name(file)
+            file.stream.flush()
+            try:
+                return render_html_page(process_upload(file, file.stream.name, uploadfilename,
+                                                       get_upload_cache_key(file), is_profile_request()))
+            except ParsingError as e:
+                flask.abort(400, "invalid source '{}': {}".format(file.filename, e))
+            except ResourceLimitError as e:
+                _logger.warning("rejected {}: {}".format(uploadfilename, e))
+                flask.abort(413, "'{}' is too large to process: {}".format(file.filename, e))
             # return redirect(url_for('ack_upload',filename=filename))
     else:
-        return '''
+        page = '''
         <!doctype html>
         <html>
         <head>
@@ -140,10 +317,12 @@ def upload_file():
         <body>
         <title>Upload new File</title>
         <h1>Upload new File</h1>
-        <form method=post enctype=multipart/form-data>
+        <form id=upload method=post enctype=multipart/form-data>
           <p><input type=file name=file>
              <input type=submit value=Upload>
         </form>
+        <p id=progress></p>
+        {jobs_script}
         <!--
         <h2>Examples of working reports</h2>
         <ol>
@@ -153,6 +332,70 @@ def upload_file():
         </body>
         </html>
         '''
+        return page.replace("{jobs_script}", UPLOAD_JOBS_SCRIPT if app.config["JOBS_ENABLED"] else "")
+
+def format_event(event_id, event, data):
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(event_id, event, json.dumps(data))
+
+
+@app.route('/jobs', methods=['POST'])
+def start_job():
+    """ generate the reports of an upload in a background job, its progress is followed at the events url
+
+    a second upload of the same content while its job runs joins that job
+    """
+    if not app.config["JOBS_ENABLED"]:
+        flask.abort(501, "report jobs need the threaded server")
+    file = request.files.get('file')
+    if file is None or file.filename == '':
+        flask.abort(400, "no file")
+    uploadfilename = get_upload_file_name(file)
+    cache_key = get_upload_cache_key(file)
+    profile = is_profile_request()
+    # the job outlives the request, its part file is moved out of reach of remove_upload_parts, and keeps the
+    # upload extension as openpyxl only opens paths named as workbooks
+    file.stream.flush()
+    fd, job_part_path = tempfile.mkstemp(prefix=".job-", suffix=".part" + os.path.splitext(uploadfilename)[1],
+                                         dir=g.config.root.reports_dir)
+    os.close(fd)
+    os.rename(file.stream.name, job_part_path)
+
+    def run_job(job):
+        try:
+            return process_upload(job_part_path, job_part_path, uploadfilename, cache_key, profile, job.progress)
+        finally:
+            if os.path.exists(job_part_path):
+                os.remove(job_part_path)
+
+    job, started = jobs.start(None if profile else cache_key, run_job)
+    if not started:
+        os.remove(job_part_path)
+    return Response(json.dumps({"job_id": job.job_id, "events": url_for("job_events", job_id=job.job_id)}),
+                    status=202, mimetype="application/json")
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """ server-sent events of a job: progress {stage, rows, total}, then done {html} or failed {message}
+
+    a reconnecting EventSource resumes after its Last-Event-ID
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        flask.abort(404, "no job {}".format(job_id))
+    last_event_id = request.headers.get("Last-Event-ID", default=-1, type=int)
+
+    def stream():
+        for item in job.iter_events(last_event_id + 1):
+            if item is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield format_event(*item)
+
+    rv = Response(stream(), mimetype="text/event-stream")
+    rv.headers["Cache-Control"] = "no-cache"
+    return rv
+
 
 @app.route('/ack_uploaded')
 def ack():
@@ -162,9 +405,86 @@ def ack():
     return render_html_page(msg, headers)
 
 
+def get_fresh_gzip_sibling(path):
+    """ relative path of the precompressed sibling of path, None when missing or older than path """
+    full_path = safe_join(g.config.root.reports_dir, path)
+    gz_path = safe_join(g.config.root.reports_dir, path + ".gz")
+    if os.path.isfile(full_path) and os.path.isfile(gz_path) and \
+            os.path.getmtime(gz_path) >= os.path.getmtime(full_path):
+        return path + ".gz"
+    return None
+
+
 @app.route('/reports/<path:path>')
 def send_reports(path):
-    return send_from_directory(g.config.root.reports_dir, path)
+    """ conditional GET (ETag/Last-Modified) and range requests are handled by send_from_directory,
+        clients accepting gzip get the precompressed sibling unless they ask for a byte range
+    """
+    gz_path = None
+    if request.range is None and "gzip" in request.accept_encodings:
+        gz_path = get_fresh_gzip_sibling(path)
+    if gz_path:
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        rv = send_from_directory(g.config.root.reports_dir, gz_path, mimetype=mimetype,
+                                 cache_timeout=g.config.root.reports_cache_timeout)
+        rv.content_encoding = "gzip"
+    else:
+        rv = send_from_directory(g.config.root.reports_dir, path, cache_timeout=g.config.root.reports_cache_timeout)
+    rv.vary.add("Accept-Encoding")
+    return rv
+
+
+def render_pager(path, page, page_count):
+    links = []
+    if page > 1:
+        links.append('<a href="/view/{}?page={}">previous</a>'.format(path, page - 1))
+    links.append("page {} of {}".format(page, page_count))
+    if page < page_count:
+        links.append('<a href="/view/{}?page={}">next</a>'.format(path, page + 1))
+    return "<p>{}</p>".format(" | ".join(links))
+
+
+@app.route('/view/<path:path>')
+def view_report(path):
+    """ one page of a saved report as an html table, read by seeking through the report's row offset index """
+    report_path = safe_join(g.config.root.reports_dir, path)
+    if not os.path.isfile(report_path + ".idx"):
+        flask.abort(404, "no row index for {}".format(path))
+    page_size = g.config.root.viewer_page_size
+    page = max(1, request.args.get("page", default=1, type=int))
+    header, rows, row_count = read_csv_rows(report_path, (page - 1) * page_size, page * page_size)
+    page_count = max(1, (row_count + page_size - 1) // page_size)
+    table = ["<table border=1>", "<tr>", "".join("<th>{}</th>".format(flask.escape(cell)) for cell in header), "</tr>"]
+    for row in rows:
+        table.append("<tr>{}</tr>".format("".join("<td>{}</td>".format(flask.escape(cell)) for cell in row)))
+    table.append("</table>")
+    pager = render_pager(path, page, page_count)
+    return render_html_page(["<h3>{}</h3>".format(flask.escape(path)), pager, "\n".join(table), pager,
+                             '<a href="/reports/{}">download</a>'.format(path)])
+
+
+@app.route('/uploads/latest')
+def latest_upload():
+    """ links of the latest completed upload, of ?source=<upload file name without extension> when given """
+    manifest = report_store.get_latest_manifest(g.config.root.reports_dir,
+                                                secure_filename(request.args.get("source", default="")))
+    if manifest is None:
+        flask.abort(404, "no completed uploads")
+    return render_html_page(["<h3>latest reports of {}</h3><br>".format(flask.escape(manifest["source_name"]))] +
+                            render_upload_links(manifest))
+
+
+@app.route('/uploads/<upload_id>/reports.zip')
+def send_reports_zip(upload_id):
+    """ all reports of an upload in one zip, compressed and streamed file by file as it is sent """
+    reports_dir = g.config.root.reports_dir
+    manifest = report_store.read_manifest(reports_dir, upload_id)
+    if manifest is None:
+        flask.abort(404, "no completed upload {}".format(upload_id))
+    upload_dir = report_store.get_upload_dir(reports_dir, upload_id)
+    rv = Response(iter_zip(upload_dir, manifest["report_file_names"]), mimetype="application/zip")
+    rv.headers.add("Content-Disposition", "attachment", filename="{}.zip".format(manifest["source_name"]))
+    return rv
 
 
 @app.route('/debug.log')
@@ -173,7 +493,35 @@ def send_log():
 
 
 def main():
-    app.run(host='0.0.0.0', port=8999, debug=True)
+    """ development server, single process with threads, with the interactive debugger when conf debug is set """
+    if g.config.root.debug is True:
+        enable_debugger()
+    app.config["JOBS_ENABLED"] = True
+    app.config["PROFILING_ENABLED"] = True
+    app.run(host=g.config.root.webapi_host, port=g.config.root.webapi_port, debug=g.config.root.debug,
+            threaded=True)
+
+
+def serve(host=None, port=None, processes=None):
+    """ production server, debugger and reloader disabled
+
+    with processes=1 every request is served in its own thread, with processes>1 werkzeug forks
+    a process per request up to that many at once, and uploads are not run as background jobs.
+    app is a plain WSGI callable and can also be served by an external WSGI server
+    (e.g. gunicorn supplier_reports.webapi.app:app), also without background jobs
+    """
+    from werkzeug.serving import run_simple
+    host = host or g.config.root.webapi_host
+    port = port or g.config.root.webapi_port
+    processes = processes or g.config.root.webapi_processes
+    app.debug = False
+    # jobs live in the memory of the process that started them
+    app.config["JOBS_ENABLED"] = processes == 1
+    app.config["PROFILING_ENABLED"] = False
+    _logger.info("serving on {}:{} with {}".format(host, port, "threads" if processes == 1 else
+                                                       "{} processes".format(processes)))
+    run_simple(host, port, app, threaded=processes == 1, processes=processes,
+               use_debugger=False, use_reloader=False)
 
 
 if __name__=='__main__':
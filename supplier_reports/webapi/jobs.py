@@ -0,0 +1,100 @@
+"""
+background report jobs of the web api, their progress is streamed to the browser as server-sent events
+
+a job runs in a thread of the serving process and keeps its events in memory, so jobs need the threaded
+server (webapi_processes = 1). a second upload of the same content while its job runs joins that job
+instead of generating the reports twice.
+"""
+
+import uuid
+import time
+import logging
+import threading
+
+_logger = logging.getLogger(__name__)
+
+
+class Job(object):
+    def __init__(self, key):
+        self.job_id = uuid.uuid4().hex
+        self.key = key
+        self.events = []
+        self.finished = False
+        self.finished_at = None
+        self.condition = threading.Condition()
+
+    def emit(self, event, data, finished=False):
+        with self.condition:
+            self.events.append((event, data))
+            if finished:
+                self.finished = True
+                self.finished_at = time.time()
+            self.condition.notify_all()
+
+    def progress(self, stage, done, total=None):
+        """ progress callback of gen_reports """
+        self.emit("progress", {"stage": stage, "rows": done, "total": total})
+
+    def iter_events(self, start=0, timeout=15):
+        """ yield (event id, event, data) from event start on until the job is finished,
+            None when no event came for timeout seconds, to keep the connection alive
+        """
+        i = start
+        while True:
+            with self.condition:
+                if i >= len(self.events) and not self.finished:
+                    self.condition.wait(timeout)
+                events = self.events[i:]
+                finished = self.finished
+            if not events:
+                if finished:
+                    return
+                yield None
+            for event, data in events:
+                yield i, event, data
+                i += 1
+
+
+class JobRegistry(object):
+    """ :param keep_seconds: finished jobs are dropped after that long, their events can not be replayed """
+    def __init__(self, keep_seconds=600):
+        self.keep_seconds = keep_seconds
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def start(self, key, target):
+        """ run target(job) in a thread, it returns the html of the result or raises
+
+        :return: job, and whether it was started by this call (False when it joined a running job of key)
+        """
+        with self.lock:
+            self.prune()
+            for job in self.jobs.values():
+                if key is not None and job.key == key and not job.finished:
+                    _logger.info("joining running job {}".format(job.job_id))
+                    return job, False
+            job = Job(key)
+            self.jobs[job.job_id] = job
+        thread = threading.Thread(target=self.run, args=(job, target), name="job-{}".format(job.job_id))
+        thread.daemon = True
+        thread.start()
+        return job, True
+
+    def run(self, job, target):
+        try:
+            html = target(job)
+        except Exception as e:
+            _logger.exception("job {} failed".format(job.job_id))
+            job.emit("failed", {"message": u"{}".format(e)}, finished=True)
+        else:
+            job.emit("done", {"html": html}, finished=True)
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def prune(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished and now - job.finished_at > self.keep_seconds:
+                del self.jobs[job_id]
@@ -0,0 +1,114 @@
+"""
+content addressed cache of generated report sets, so re-uploading the same export does not rerun gen_reports
+
+the entries are kept in an index file under reports_dir/uploads next to the upload manifests, so every
+server process, forked ones included (webapi_processes > 1), sees the report sets cached by the others.
+"""
+
+import os
+import json
+import fcntl
+import logging
+import contextlib
+from collections import OrderedDict
+from supplier_reports.python_script_common import atomic_write
+from supplier_reports.report_store import UPLOADS_DIR
+
+_logger = logging.getLogger(__name__)
+
+INDEX_FILE_NAME = "report_cache.json"
+LOCK_FILE_NAME = "report_cache.lock"
+
+
+class ReportCache(object):
+    """ LRU of upload key -> report file names saved in reports_dir
+
+    the key is the upload content hash plus the schemas signature. entries are evicted least recently used
+    first, when there are more than max_entries or their report files add up to more than max_bytes.
+    a hit is only served while the report files are unchanged since they were cached.
+
+    :param on_evict: callable(directory, file names) of an evicted entry, to remove its files
+    """
+    def __init__(self, max_entries, max_bytes, on_evict=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+
+    @staticmethod
+    def stat_files(directory, file_names):
+        stats = []
+        for file_name in file_names:
+            st = os.stat(os.path.join(directory, file_name))
+            stats.append([file_name, st.st_mtime, st.st_size])
+        return stats
+
+    @staticmethod
+    def get_index_path(directory):
+        return os.path.join(directory, UPLOADS_DIR, INDEX_FILE_NAME)
+
+    @contextlib.contextmanager
+    def index_context(self, directory):
+        """ entries of the index of directory, least recently used first, written back when the block succeeds
+
+        the index is locked for the block, a lock file is used as the index itself is replaced on write
+        """
+        uploads_dir = os.path.join(directory, UPLOADS_DIR)
+        if not os.path.isdir(uploads_dir):
+            os.makedirs(uploads_dir)
+        index_path = self.get_index_path(directory)
+        with open(os.path.join(uploads_dir, LOCK_FILE_NAME), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(index_path) as f:
+                    entries = json.load(f, object_pairs_hook=OrderedDict)
+            except IOError:
+                entries = OrderedDict()
+            yield entries
+            with atomic_write(index_path, "w") as f:
+                json.dump(entries, f)
+
+    @staticmethod
+    def get_total_bytes(entries):
+        return sum(size for stats in entries.values() for file_name, mtime, size in stats)
+
+    def get_entries(self, directory):
+        """ :return: cached keys, least recently used first """
+        with self.index_context(directory) as entries:
+            return list(entries)
+
+    def get(self, key, directory):
+        """ :return: cached report file names, None on a miss """
+        if not os.path.isfile(self.get_index_path(directory)):
+            return None
+        with self.index_context(directory) as entries:
+            stats = entries.pop(key, None)
+            if stats is None:
+                return None
+            file_names = [file_name for file_name, mtime, size in stats]
+            try:
+                fresh = self.stat_files(directory, file_names) == stats
+            except OSError:
+                fresh = False
+            if not fresh:
+                _logger.info("dropping stale report cache entry {}".format(key))
+                return None
+            entries[key] = stats
+            return file_names
+
+    def put(self, key, directory, file_names):
+        stats = self.stat_files(directory, file_names)
+        evicted_entries = []
+        with self.index_context(directory) as entries:
+            entries.pop(key, None)
+            entries[key] = stats
+            while entries and (len(entries) > self.max_entries or self.get_total_bytes(entries) > self.max_bytes):
+                evicted_key, evicted = entries.popitem(last=False)
+                _logger.debug("evicted report cache entry {}".format(evicted_key))
+                evicted_entries.append(evicted)
+        if self.on_evict is not None:
+            for evicted in evicted_entries:
+                self.on_evict(directory, [file_name for file_name, mtime, size in evicted])
+
+    def clear(self, directory):
+        with self.index_context(directory) as entries:
+            entries.clear()
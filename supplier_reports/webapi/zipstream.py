@@ -0,0 +1,81 @@
+"""
+zip archives streamed as a response body, one compressed chunk at a time
+
+zipfile.ZipFile.write seeks back to patch the local header once the CRC is known, which a response body
+cannot do. here every member is written with a data descriptor (flag bit 3) after its data instead,
+and ZipFile only writes the central directory on close
+"""
+
+import os
+import time
+import zlib
+import struct
+import zipfile
+
+DATA_DESCRIPTOR = struct.Struct("<4sLLL")
+DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+
+
+class _TellingSink(object):
+    """ write only file object for ZipFile, collects the bytes until the generator drains them """
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.offset += len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_zip(directory, file_names, chunk_size=64*1024, compresslevel=6):
+    """ generate the bytes of a zip archive of file_names in directory
+
+    only one chunk of one member is held in memory at a time
+    """
+    sink = _TellingSink()
+    archive = zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED)
+    for file_name in file_names:
+        file_path = os.path.join(directory, file_name)
+        zinfo = zipfile.ZipInfo(file_name, date_time=time.localtime(os.path.getmtime(file_path))[:6])
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.external_attr = 0o644 << 16
+        zinfo.flag_bits |= 0x08
+        zinfo.header_offset = sink.tell()
+        sink.write(zinfo.FileHeader())
+        yield sink.drain()
+
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        crc = file_size = compress_size = 0
+        with open(file_path, "rb") as fo:
+            for chunk in iter(lambda: fo.read(chunk_size), b""):
+                crc = zlib.crc32(chunk, crc)
+                file_size += len(chunk)
+                data = compressor.compress(chunk)
+                if data:
+                    compress_size += len(data)
+                    sink.write(data)
+                    yield sink.drain()
+        data = compressor.flush()
+        compress_size += len(data)
+        sink.write(data)
+
+        zinfo.CRC = crc & 0xffffffff
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        sink.write(DATA_DESCRIPTOR.pack(DATA_DESCRIPTOR_SIGNATURE, zinfo.CRC, compress_size, file_size))
+        archive.filelist.append(zinfo)
+        archive.NameToInfo[file_name] = zinfo
+        yield sink.drain()
+    archive.close()
+    yield sink.drain()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from openpyxl import Workbook
+from collections import OrderedDict
+from supplier_reports import conf as g
+import tempfile,os
+import shutil
+
+
+SHIPPING = OrderedDict([("Shipping Name", "Jane"), ("Shipping Street", "1 Main st"), ("Shipping Address1", "1 Main st"),
+                        ("Shipping Address2", None), ("Shipping Company", None), ("Shipping City", "Springfield"),
+                        ("Shipping Zip", "12345"), ("Shipping Province", None), ("Shipping Country", "US"),
+                        ("Phone", None), ("Billing Phone", "555-1234"), ("Shipping Phone", None), ("Notes", None)])
+
+
+def order_row(name, vendor, lineitem, first_in_group=True):
+    row = OrderedDict([("Name", name), ("Vendor", vendor), ("Lineitem name", lineitem), ("Variant", "v1"),
+                       ("Lineitem quantity", 1), ("Created at", "2018-02-14"), ("Fulfillment Status", "pending"),
+                       ("Lineitem sku", "sku-" + lineitem), ("Size", "M"), ("Color", "red"), ("Frame option", "none")])
+    for k, v in SHIPPING.items():
+        row[k] = v if first_in_group else None
+    return row
+
+
+def export_orders_data():
+    return [order_row("#1001", "Zhen", "shirt"),
+            order_row("#1001", "Mr Art Painting store", "painting", first_in_group=False),
+            order_row("#1002", "Zhen", "hat"),
+            order_row("#1003", "Mr Art Painting store", "painting")]
+
+
+def product_list_data():
+    return [OrderedDict([("Vendor", "Zhen"), ("Lineitem name", "shirt"), ("Product link", "http://a/shirt")]),
+            OrderedDict([("Vendor", "Zhen"), ("Lineitem name", "hat"), ("Product link", "http://a/hat")]),
+            OrderedDict([("Vendor", "Mr Art Painting store"), ("Lineitem name", "painting"),
+                         ("Product link", "http://a/painting")])]
+
+
+def create_workbook(filename, sheets):
+    """ sheets is a list of (title, list of OrderedDict) """
+    wb = Workbook()
+    wb.remove(wb.active)
+    for title, data in sheets:
+        ws = wb.create_sheet(title=title)
+        ws.append(list(data[0].keys()))
+        for rowdict in data:
+            ws.append(list(rowdict.values()))
+    wb.save(filename=filename)
+    return filename
+
+
+def create_orders_export(filename, orders=None, products=None):
+    return create_workbook(filename, [("Export orders", orders or export_orders_data()),
+                                      ("Product list", products or product_list_data())])
+
+
+def create_csv_sheets(dir_path, sheets, file_names=None):
+    """ sheets as in create_workbook, written as <title>.csv files of dir_path """
+    import unicodecsv as csv
+    file_names = file_names or ["{}.csv".format(title) for title, data in sheets]
+    for file_name, (title, data) in zip(file_names, sheets):
+        with open(os.path.join(dir_path, file_name), "wb") as fo:
+            writer = csv.writer(fo, encoding="utf-8")
+            writer.writerow(list(data[0].keys()))
+            for rowdict in data:
+                writer.writerow(["" if v is None else v for v in rowdict.values()])
+    return dir_path
+
+
+def create_csv_bundle(filename, sheets, file_names=None):
+    """ sheets as in create_workbook, written as a zip of csv files """
+    import zipfile
+    dir_path = tempfile.mkdtemp()
+    try:
+        create_csv_sheets(dir_path, sheets, file_names)
+        with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED) as archive:
+            for file_name in os.listdir(dir_path):
+                archive.write(os.path.join(dir_path, file_name), file_name)
+    finally:
+        shutil.rmtree(dir_path)
+    return filename
+
+
+@pytest.fixture
+def tmp_dir():
+    dir_path = tempfile.mkdtemp()
+    try:
+        yield dir_path
+    finally:
+        shutil.rmtree(dir_path)
+
+
+@pytest.fixture
+def reports_dir(tmp_dir):
+    path = os.path.join(tmp_dir, "reports")
+    os.mkdir(path)
+    with g.config.backup_context():
+        g.config.root.reports_dir = path
+        yield path
+
+
+@pytest.fixture
+def orders_export_file(tmp_dir):
+    return create_orders_export(os.path.join(tmp_dir, "orders_export.xlsx"))
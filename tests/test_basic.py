@@ -5,6 +5,8 @@ from openpyxl import Workbook
 from openpyxl.compat import range
 from supplier_reports.gen_reports import read_xlsx_sheet, SimpleSchemaValidator,GroupingError
 from supplier_reports import gen_reports
+from supplier_reports.python_script_common import profiling_context
+import pstats
 import tempfile,os
 import logging
 import copy
@@ -28,6 +30,11 @@ def create_xlsx_sheet(filename, title, data):
     return wb
 
 
+def report_contents(reports):
+    """ (file name, content) of the reports gen_reports yields, to compare the reports of different sources """
+    return sorted((r.get_report_file_name(), r.file.getvalue()) for r in reports if r is not None)
+
+
 @contextlib.contextmanager
 def tempdir_context():
     dir_path = tempfile.mkdtemp()
@@ -166,6 +173,40 @@ def test_primary_keys():
         sv.validate_table(data3, post_process=True)
 
 
+def test_validate_table_row_errors():
+    schema = {'primary_keys': ['a'], 'not_empty': ['b'],
+              'fill_missing': [{'field': 'c', 'from': ['b']}],
+              'fill_grouped': {'on': 'g', 'by': ['d']}}
+    data = [{'a': i + 1, 'b': i + 1, 'c': None, 'g': i // 3, 'd': i if i % 3 == 0 else None} for i in range(10)]
+    sv = SimpleSchemaValidator(schema)
+    assert sv.validate_table(data, post_process=True)[4] == {'a': 5, 'b': 5, 'c': 5, 'g': 1, 'd': 3}
+    assert data[4]['c'] is None, "fill_missing fills a copy of the row"
+
+    _logger.info("errors keep their row numbers")
+    for row, change, error in ((7, {'b': None}, gen_reports.EmptyValueError),
+                               (9, {'a': 2}, gen_reports.PrimaryKeyError),
+                               (6, {'g': 0}, GroupingError)):
+        invalid = copy.deepcopy(data)
+        invalid[row - 1].update(change)
+        with pytest.raises(error) as e:
+            sv.validate_table(invalid, post_process=True)
+        assert "error in row {}".format(row) in e.value.args
+        assert "row=<{}>".format(invalid[row - 1]) in e.value.args
+
+
+def test_validate_table_progress(monkeypatch):
+    monkeypatch.setattr(gen_reports, "PROGRESS_EVERY", 4)
+    calls = []
+    data = [{'a': i + 1} for i in range(10)]
+    sv = SimpleSchemaValidator({'description': 'numbers', 'primary_keys': ['a']})
+    sv.validate_table(data, progress=lambda *args: calls.append(args))
+    assert calls == [("validating 'numbers'", done, 10) for done in (0, 4, 8, 10)]
+    del calls[:]
+    sv = SimpleSchemaValidator({'match_row_key': 'a', 'match_row_value': 1, 'report_fields': ['a']})
+    assert sv.export_fields(data, progress=lambda *args: calls.append(args)) == [{'a': 1}]
+    assert calls[-1] == ("exporting '1'", 10, 10)
+
+
 def test_not_empty():
     schema = {'not_empty': ['a']
               }
@@ -256,6 +297,123 @@ def test_export_with_lookup_match(valid_export_data):
     assert report == expected, "report:\n'{}' does not match expected:\n'{}'".format(report,expected)
 
 
+def test_lookup_projection_is_memoized(valid_export_data):
+    lookup_lod = [{'a': 1, 'e': 2, 'f': 5}, {'a': 2, 'e': 3, 'f': 6}]
+    lookupd = gen_reports.LookupDict(lookup_lod, ['a'])
+    calls = []
+    get_matching_dict_for = lookupd.get_matching_dict_for
+    lookupd.get_matching_dict_for = lambda rdict: calls.append(rdict) or get_matching_dict_for(rdict)
+
+    reports = [SimpleSchemaValidator({'match_row_key': 'a', 'match_row_value': value,
+                                      'report_fields': ["a", "b", "e"]}).export_fields(valid_export_data, lookupd)
+               for value in (1, 2, 1)]
+    assert reports[0] == reports[2] == [{'a': 1, 'b': 1, 'e': 2}, {'a': 1, 'b': None, 'e': 2}]
+    assert len(calls) == 2, "one lookup per distinct key, shared by rows and reports"
+    assert lookupd.get_projection_for({'a': 1}, ('e', 'f')) == (('e', 2), ('f', 5))
+    assert lookupd.get_projection_for({'a': 1}, ('e',)) is lookupd.get_projection_for({'a': 1, 'b': 7}, ('e',))
+
+
+def test_disk_lookup(orders_export_file, reports_dir, tmp_dir):
+    from supplier_reports import conf as g
+    from supplier_reports.disk_lookup import build_disk_lookup, DiskLookupDict
+    from tests.conftest import create_workbook, export_orders_data, product_list_data
+    products = product_list_data()
+    path = build_disk_lookup(os.path.join(tmp_dir, "a.lookup"), iter(products), ["Vendor", "Lineitem name"])
+    lookupd = DiskLookupDict(path)
+    try:
+        assert len(lookupd) == 3 and lookupd.fields == ["Vendor", "Lineitem name", "Product link"]
+        for rowdict in products:
+            assert lookupd.get_matching_dict_for(rowdict) == rowdict
+    finally:
+        lookupd.close()
+    lookupd = DiskLookupDict(build_disk_lookup(os.path.join(tmp_dir, "b.lookup"),
+                                               [{'a': 2, 'e': 3}, {'a': 3, 'e': 4}, {'a': 2, 'e': 5}], ['a']))
+    try:
+        assert lookupd.get_matching_dict_for({'a': 2}) == {'a': 2, 'e': 5}, "a later row wins"
+        with pytest.raises(gen_reports.LookupKeyError):
+            lookupd.get_matching_dict_for({'a': 1})
+    finally:
+        lookupd.close()
+
+    expected = [(r.get_report_file_name(), r.file.getvalue()) for r in gen_reports.gen_reports(orders_export_file)]
+    g.config.root.lookup_backend = "disk"
+    g.config.root.product_lookup_path = os.path.join(tmp_dir, "lookups", "products.lookup")
+    orders_only = create_workbook(os.path.join(tmp_dir, "orders_only.xlsx"), [("Export orders", export_orders_data())])
+    with pytest.raises(IOError):
+        list(gen_reports.gen_reports(orders_only))
+    _logger.info("the catalogue is imported once, sources then need no product list")
+    signature = gen_reports.get_schemas_signature()
+    gen_reports.import_product_catalogue(orders_export_file)
+    assert [(r.get_report_file_name(), r.file.getvalue()) for r in gen_reports.gen_reports(orders_only, name="orders_export")] == expected
+    assert gen_reports.get_schemas_signature() != signature, "cached reports of the catalogue are stale"
+    signature = gen_reports.get_schemas_signature()
+    gen_reports.import_product_catalogue(orders_export_file)
+    assert gen_reports.get_schemas_signature() != signature, "every import is a new catalogue"
+
+
+def test_memory_guard(orders_export_file, reports_dir, tmp_dir, monkeypatch):
+    from supplier_reports import conf as g
+    from supplier_reports.python_script_common import get_rss
+    from tests.conftest import create_csv_bundle, export_orders_data, product_list_data
+
+    bundle = create_csv_bundle(os.path.join(tmp_dir, "orders_export.zip"),
+                               [("Export orders", export_orders_data()), ("Product list", product_list_data())])
+    assert gen_reports.open_table_source(bundle).sheet_dimensions("Export orders") == (4, 24)
+    assert gen_reports.open_table_source(orders_export_file).sheet_dimensions("Export orders") == (4, 24)
+    expected = report_contents(gen_reports.gen_reports(orders_export_file))
+
+    _logger.info("sources estimated over the rss budget are streamed")
+    g.config.root.rss_budget = 256 * 2**20
+    g.config.root.source_cell_bytes = 2**30
+    for source in (orders_export_file, bundle):
+        assert gen_reports.MemoryGuard.from_config().check_source(gen_reports.open_table_source(source),
+                                                                  gen_reports.REQUIRED_SHEETS)
+        orders, products = gen_reports.load_source_tables(source)
+        assert isinstance(products, gen_reports.LookupBase)
+        assert report_contents(gen_reports.iter_reports(orders, products, "orders_export")) == expected
+
+    _logger.info("sources over the limits are rejected")
+    g.config.root.max_source_rows = 3
+    with pytest.raises(gen_reports.ResourceLimitError) as e:
+        list(gen_reports.gen_reports(orders_export_file))
+    assert "4 rows" in str(e.value)
+
+    _logger.info("sheets without dimensions are loaded, their rows are counted while read")
+    from openpyxl import Workbook
+    os.mkdir(os.path.join(tmp_dir, "write_only"))
+    write_only = os.path.join(tmp_dir, "write_only", "orders_export.xlsx")
+    wb = Workbook(write_only=True)
+    for title, data in (("Export orders", export_orders_data()), ("Product list", product_list_data())):
+        ws = wb.create_sheet(title=title)
+        ws.append(list(data[0].keys()))
+        for rowdict in data:
+            ws.append(list(rowdict.values()))
+    wb.save(write_only)
+    assert gen_reports.open_table_source(write_only).sheet_dimensions("Export orders") is None
+    with pytest.raises(gen_reports.ResourceLimitError) as e:
+        list(gen_reports.gen_reports(write_only))
+    assert "more than the limit of 3 rows" in str(e.value)
+    g.config.root.max_source_rows = 0
+    guard = gen_reports.MemoryGuard.from_config()
+    assert not guard.check_source(gen_reports.open_table_source(write_only), gen_reports.REQUIRED_SHEETS)
+    assert guard.unmeasured == set(gen_reports.REQUIRED_SHEETS)
+    assert report_contents(gen_reports.gen_reports(write_only)) == expected
+    _logger.info("the rss budget is counted from the start of the run")
+    rss = [get_rss()]
+    monkeypatch.setattr(gen_reports, "get_rss", lambda: rss.append(rss[-1] + 2**20) or rss[-1])
+    g.config.root.rss_budget = 2**30
+    assert report_contents(gen_reports.gen_reports(bundle)) == expected
+    g.config.root.rss_budget = 2 * 2**20
+    with pytest.raises(gen_reports.ResourceLimitError) as e:
+        list(gen_reports.gen_reports(bundle))
+    assert "out of memory budget" in str(e.value)
+
+
+def test_iter_xlsx_sheet(orders_export_file):
+    assert list(gen_reports.iter_xlsx_sheet(orders_export_file, "Export orders")) == \
+        read_xlsx_sheet(orders_export_file, "Export orders")
+
+
 def test_export_with_lookup_match_error(valid_export_data):
     _logger.info("test no local match key no lookup")
     report_schema = {
@@ -273,3 +431,217 @@ def test_export_with_lookup_match_error(valid_export_data):
     lookupd = gen_reports.LookupDict(lookup_lod, ['a'])
     with pytest.raises(gen_reports.LookupKeyError):
         sv.export_fields(valid_export_data, lookupd)
+
+
+
+def test_profiling_context():
+    with tempdir_context() as tmpdirname:
+        stats_path = os.path.join(tmpdirname, "test.prof")
+        with profiling_context(stats_path, enabled=False):
+            sorted(range(100))
+        assert not os.path.exists(stats_path)
+
+        with profiling_context(stats_path):
+            sorted(range(100))
+        stats = pstats.Stats(stats_path)
+        assert stats.total_calls > 0
+
+
+def test_gen_reports_sources(orders_export_file):
+    import mmap
+    from werkzeug.datastructures import FileStorage
+
+    expected = report_contents(gen_reports.gen_reports(orders_export_file))
+    assert [name for name, _ in expected] == ["orders_export-Mr_Art_Painting_store.csv", "orders_export-Zhen.csv"]
+
+    with open(orders_export_file, "rb") as fo:
+        assert report_contents(gen_reports.gen_reports(fo)) == expected
+        buf = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            assert report_contents(gen_reports.gen_reports(buf, name="orders_export")) == expected
+        finally:
+            buf.close()
+        fs = FileStorage(fo, filename="orders_export.xlsx")
+        assert report_contents(gen_reports.gen_reports(fs)) == expected
+
+
+def test_check_source_sheets(orders_export_file, tmp_dir):
+    assert gen_reports.get_xlsx_sheet_names(orders_export_file) == ["Export orders", "Product list"]
+    table_source = gen_reports.open_table_source(orders_export_file)
+    gen_reports.check_source_sheets(table_source)
+    with pytest.raises(gen_reports.ParsingError):
+        gen_reports.check_source_sheets(table_source, ["Export orders", "Missing"])
+
+    not_xlsx = os.path.join(tmp_dir, "not.xlsx")
+    with open(not_xlsx, "w") as fo:
+        fo.write("a,b,c")
+    with pytest.raises(gen_reports.ParsingError):
+        gen_reports.get_xlsx_sheet_names(not_xlsx)
+
+
+def test_gen_reports_csv_sources(orders_export_file, tmp_dir):
+    from tests.conftest import create_csv_sheets, create_csv_bundle, export_orders_data, product_list_data
+
+    expected = report_contents(gen_reports.gen_reports(orders_export_file))
+    sheets = [("Export orders", export_orders_data()), ("Product list", product_list_data())]
+    bundle = create_csv_bundle(os.path.join(tmp_dir, "orders_export.zip"), sheets)
+    assert isinstance(gen_reports.open_table_source(bundle), gen_reports.CsvZipSource)
+    assert isinstance(gen_reports.open_table_source(orders_export_file), gen_reports.XlsxSource)
+    assert report_contents(gen_reports.gen_reports(bundle)) == expected
+
+    csv_dir = os.path.join(tmp_dir, "orders_export")
+    os.mkdir(csv_dir)
+    # shopify style file names
+    create_csv_sheets(csv_dir, sheets, ["export_orders.csv", "Product List.csv"])
+    assert report_contents(gen_reports.gen_reports(csv_dir)) == expected
+    assert report_contents(gen_reports.gen_reports(csv_dir + os.sep)) == expected
+
+    os.remove(os.path.join(csv_dir, "Product List.csv"))
+    with pytest.raises(gen_reports.ParsingError):
+        gen_reports.check_source_sheets(gen_reports.open_table_source(csv_dir))
+    not_source = os.path.join(tmp_dir, "not.zip")
+    with open(not_source, "w") as fo:
+        fo.write("a,b,c")
+    with pytest.raises(gen_reports.ParsingError):
+        gen_reports.open_table_source(not_source)
+
+
+def test_read_csv_rows_with_index():
+    rows = [{'a': i, 'b': u"line\nbreak, \"quoted\" {}".format(i)} for i in range(7)]
+    report_file, row_offsets = gen_reports.get_csv_report(rows, ['a', 'b'])
+    with tempdir_context() as tmpdirname:
+        report = gen_reports.CsvReport({'match_row_value': 'x'}, report_file, row_offsets=row_offsets)
+        report.save(tmpdirname)
+        assert os.listdir(tmpdirname) == ["x.csv"], "no sidecars unless asked for"
+        report.save(tmpdirname, sidecars=True)
+        report_path = os.path.join(tmpdirname, report.get_report_file_name())
+        header, page, row_count = gen_reports.read_csv_rows(report_path, 3, 5)
+        assert header == ['a', 'b'] and row_count == 7
+        assert page == [[u'3', rows[3]['b']], [u'4', rows[4]['b']]]
+        assert gen_reports.read_csv_rows(report_path, 6, 100)[1] == [[u'6', rows[6]['b']]]
+        assert gen_reports.read_csv_rows(report_path, 10, 20)[1] == []
+
+
+def test_atomic_write():
+    from supplier_reports.python_script_common import atomic_write
+    with tempdir_context() as tmpdirname:
+        file_path = os.path.join(tmpdirname, "report.csv")
+        with atomic_write(file_path, "w") as f:
+            f.write("first")
+            assert not os.path.exists(file_path), "nothing is visible before the block completes"
+        with pytest.raises(ValueError):
+            with atomic_write(file_path, "w") as f:
+                f.write("partial")
+                raise ValueError()
+        assert open(file_path).read() == "first"
+        assert os.listdir(tmpdirname) == ["report.csv"]
+        with open(os.path.join(tmpdirname, "plain.csv"), "w") as f:
+            f.write("first")
+        assert os.stat(file_path).st_mode == os.stat(os.path.join(tmpdirname, "plain.csv")).st_mode
+
+
+def test_schema_registry():
+    import json
+    schema = {"description": "report schema x", "match_row_key": "Vendor", "match_row_value": "X",
+              "report_fields": ["Name", "Product link"]}
+    with tempdir_context() as tmpdirname:
+        path = os.path.join(tmpdirname, "report_schemas.json")
+
+        def write(schemas, mtime):
+            with open(path, "w") as f:
+                json.dump({"report_schemas": schemas}, f)
+            os.utime(path, (mtime, mtime))
+
+        write([schema], 1000)
+        registry = gen_reports.SchemaRegistry(path)
+        schemas = registry.get_report_schemas()
+        assert [s["match_row_value"] for s in schemas] == ["X"]
+        assert isinstance(schemas[0], gen_reports.SchemaDescription)
+        assert registry.get_report_schemas() is schemas, "not reloaded while unchanged"
+
+        signature = registry.signature
+        write([schema, dict(schema, match_row_value="Y")], 2000)
+        assert [s["match_row_value"] for s in registry.get_report_schemas()] == ["X", "Y"]
+        assert registry.signature != signature
+
+        _logger.info("an invalid change keeps the previous schemas")
+        write([schema, dict(schema, report_fieldz=[])], 3000)
+        assert [s["match_row_value"] for s in registry.get_report_schemas()] == ["X", "Y"]
+        write([schema, "report schema y"], 3500)
+        assert [s["match_row_value"] for s in registry.get_report_schemas()] == ["X", "Y"]
+
+        for invalid in ([dict(schema, new_fields=["Price"])],
+                        [schema, schema],
+                        [schema, ["Name"]],
+                        [dict(schema, output_formats=["pdf"])],
+                        [dict((k, v) for k, v in schema.items() if k != "match_row_key")]):
+            write(invalid, 4000)
+            with pytest.raises(gen_reports.SchemaError):
+                gen_reports.SchemaRegistry(path)
+
+
+def test_packaged_report_schemas():
+    schemas = gen_reports.get_report_schemas()
+    assert sorted(s["match_row_value"] for s in schemas) == ["Mr Art Painting store", "Zhen"]
+
+
+def test_xlsx_output_format(orders_export_file, reports_dir):
+    import io, json
+    import unicodecsv as csv
+    from openpyxl import load_workbook
+    from supplier_reports import conf as g
+    with open(g.config.root.report_schemas_path, "rb") as f:
+        data = json.load(f)
+    for schema in data["report_schemas"]:
+        if schema["match_row_value"] == "Zhen":
+            schema["output_formats"] = ["csv", "xlsx"]
+    g.config.root.report_schemas_path = os.path.join(reports_dir, "report_schemas.json")
+    with open(g.config.root.report_schemas_path, "w") as f:
+        json.dump(data, f)
+
+    reports = [r for r in gen_reports.gen_reports(orders_export_file) if r is not None]
+    assert sorted(r.get_report_file_name() for r in reports) == ["orders_export-Mr_Art_Painting_store.csv",
+                                                                  "orders_export-Zhen.csv", "orders_export-Zhen.xlsx"]
+    for report in reports:
+        report.save(reports_dir, sidecars=True)
+    assert os.path.exists(os.path.join(reports_dir, "orders_export-Zhen.csv.gz"))
+    assert not os.path.exists(os.path.join(reports_dir, "orders_export-Zhen.xlsx.gz"))
+    with open(os.path.join(reports_dir, "orders_export-Zhen.csv"), "rb") as f:
+        csv_rows = [[v or None for v in row] for row in csv.reader(f)]
+    ws = load_workbook(os.path.join(reports_dir, "orders_export-Zhen.xlsx"), read_only=True)["Zhen"]
+    assert [[u"{}".format(c.value) if c.value is not None else None for c in row] for row in ws.rows] == csv_rows
+
+    report = gen_reports.XlsxReport({"match_row_value": "A/B Prints: [old]"}, [{"a": 1}], ["a"], prefix="x")
+    report.save(reports_dir)
+    assert report.get_report_file_name() == "x-A_B_Prints:_[old].xlsx"
+    ws = load_workbook(os.path.join(reports_dir, report.get_report_file_name()), read_only=True)["A_B Prints_ _old_"]
+    assert [[c.value for c in row] for row in ws.rows] == [["a"], [1]]
+
+
+def test_export_with_partition(valid_export_data):
+    report_schema = {
+        'match_row_key': 'a',
+        'match_row_value': 2,
+        'report_fields': ["a", "b"]
+    }
+    partition = gen_reports.PartitionIndex(valid_export_data, 'a')
+    assert partition == {1: [0, 1], 2: [2, 3]}
+    sv = SimpleSchemaValidator(report_schema)
+    assert sv.export_fields(valid_export_data, partition=partition) == sv.export_fields(valid_export_data)
+    assert sv.export_fields(valid_export_data, partition=partition) == [{'a': 2, 'b': 2}, {'a': 2, 'b': None}]
+
+    unmatched = gen_reports.get_unmatched_partitions({'a': partition}, [report_schema])
+    assert unmatched == {('a', 1): 2}
+
+
+def test_grouping_non_contiguous(valid_grouped_first_line):
+    schema, input_table, expected_table = valid_grouped_first_line
+    schema = copy.deepcopy(schema)
+    schema['fill_grouped']['contiguous'] = False
+
+    _logger.info("rows of a group split by other groups, as in exports sorted by vendor")
+    line1, line2, line3, line4 = copy.deepcopy(input_table)
+    line1_exp, line2_exp, line3_exp, line4_exp = expected_table
+    sv = SimpleSchemaValidator(schema)
+    grouped_table = sv.validate_table([line2, line3, line1, line4], post_process=True)
+    assert grouped_table == [line2_exp, line3_exp, line1_exp, line4_exp]
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+import os
+import supplier_reports
+from tests.conftest import create_orders_export
+
+
+def test_batch_file_paths(tmp_dir):
+    for name in ("b.xlsx", "a.xlsx", "c.csv"):
+        open(os.path.join(tmp_dir, name), "w").close()
+    assert [os.path.basename(p) for p in supplier_reports.get_batch_file_paths(tmp_dir)] == ["a.xlsx", "b.xlsx"]
+    assert supplier_reports.get_batch_file_paths(os.path.join(tmp_dir, "*.csv")) == [os.path.join(tmp_dir, "c.csv")]
+
+
+def test_run_batch(tmp_dir, reports_dir):
+    sources = os.path.join(tmp_dir, "sources")
+    os.mkdir(sources)
+    create_orders_export(os.path.join(sources, "store1.xlsx"))
+    create_orders_export(os.path.join(sources, "store2.xlsx"))
+    open(os.path.join(sources, "broken.xlsx"), "w").close()
+
+    results = supplier_reports.run_batch(sources, jobs=2)
+    by_name = {os.path.basename(r[0]): r for r in results}
+    assert by_name["store1.xlsx"][1] == 2 and by_name["store1.xlsx"][3] is None
+    assert by_name["broken.xlsx"][3] is not None
+    csv_files = sorted(f for f in os.listdir(reports_dir) if f.endswith(".csv"))
+    assert csv_files == ["store1-Mr_Art_Painting_store.csv", "store1-Zhen.csv",
+                         "store2-Mr_Art_Painting_store.csv", "store2-Zhen.csv"]
+    assert sorted(os.listdir(reports_dir)) == csv_files, "no sidecars outside of web uploads"
+    assert "broken.xlsx" in supplier_reports.format_batch_summary(results)
+
+
+def test_run_batch_profile(tmp_dir, reports_dir):
+    sources = os.path.join(tmp_dir, "sources")
+    os.mkdir(sources)
+    create_orders_export(os.path.join(sources, "store1.xlsx"))
+    create_orders_export(os.path.join(sources, "store2.xlsx"))
+    supplier_reports.run_batch(sources, jobs=2, profile=True)
+    stats = sorted(f.split("-")[0] for f in os.listdir(reports_dir) if f.endswith(".prof"))
+    assert stats == ["store1", "store2"], "one profile per file, saved by its worker"
+
+
+def test_batch_exit_code(tmp_dir, reports_dir, monkeypatch):
+    import sys
+    import pytest
+    sources = os.path.join(tmp_dir, "sources")
+    os.mkdir(sources)
+    create_orders_export(os.path.join(sources, "store1.xlsx"))
+    monkeypatch.setattr(supplier_reports, "set_logging", lambda **kwargs: None)
+    monkeypatch.setattr(sys, "argv", ["supplier_reports", "--batch", sources, "--jobs", "1"])
+    supplier_reports.main()
+    open(os.path.join(sources, "broken.xlsx"), "w").close()
+    with pytest.raises(SystemExit) as excinfo:
+        supplier_reports.main()
+    assert excinfo.value.code == 1, "a failed file fails the run"
+
+
+def test_cli_import_is_lazy():
+    import subprocess, sys
+    statement = ("import sys, supplier_reports; "
+                 "sys.exit(len([m for m in ('flask', 'werkzeug', 'jinja2', 'openpyxl') if m in sys.modules]))")
+    assert subprocess.call([sys.executable, "-c", statement]) == 0
+
+
+def test_run_merge(tmp_dir, reports_dir):
+    import unicodecsv as csv
+    from tests.conftest import order_row
+    sources = os.path.join(tmp_dir, "sources")
+    os.mkdir(sources)
+    create_orders_export(os.path.join(sources, "store1.xlsx"))
+    create_orders_export(os.path.join(sources, "store2.xlsx"),
+                         orders=[order_row("#2001", "Zhen", "hat"), order_row("#2002", "Zhen", "shirt")])
+
+    saved = supplier_reports.run_merge(sources, jobs=2, name="eod")
+    assert sorted(saved) == ["eod-Mr_Art_Painting_store.csv", "eod-Zhen.csv"]
+    with open(os.path.join(reports_dir, "eod-Zhen.csv"), "rb") as fo:
+        assert [row["Name"] for row in csv.DictReader(fo)] == ["#1001", "#1002", "#2001", "#2002"]
+
+
+def test_merge_conflicts(tmp_dir):
+    import pytest
+    from supplier_reports import gen_reports
+    from collections import OrderedDict
+    from tests.conftest import order_row, product_list_data
+    store1 = create_orders_export(os.path.join(tmp_dir, "store1.xlsx"))
+    store2 = create_orders_export(os.path.join(tmp_dir, "store2.xlsx"), orders=[order_row("#1001", "Zhen", "hat")])
+    with pytest.raises(gen_reports.GroupingError):
+        list(gen_reports.gen_merged_reports([store1, store2]))
+
+    products = product_list_data()
+    products[0]["Product link"] = "http://b/shirt"
+    store3 = create_orders_export(os.path.join(tmp_dir, "store3.xlsx"), orders=[order_row("#3001", "Zhen", "hat")],
+                                  products=products)
+    with pytest.raises(gen_reports.PrimaryKeyError):
+        list(gen_reports.gen_merged_reports([store1, store3]))
+
+    reordered = [OrderedDict(reversed(list(rowdict.items()))) for rowdict in product_list_data()]
+    store4 = create_orders_export(os.path.join(tmp_dir, "store4.xlsx"), orders=[order_row("#4001", "Zhen", "hat")],
+                                  products=reordered)
+    assert [r for r in gen_reports.gen_merged_reports([store1, store4]) if r is not None]
+
+
+def test_order_store(tmp_dir):
+    import datetime
+    from supplier_reports.order_store import order_store_context
+    from tests.conftest import export_orders_data, product_list_data, order_row
+    with order_store_context(os.path.join(tmp_dir, "orders.sqlite")) as store:
+        first = store.ingest("day1", export_orders_data(), product_list_data())
+        products = product_list_data()
+        products[0]["Product link"] = "http://b/shirt"
+        orders = [order_row("#1002", "Zhen", "shirt"), order_row("#1004", "Zhen", "hat")]
+        orders[1]["Created at"] = "2018-02-20 10:00:00 -0500"
+        second = store.ingest("day2", orders, products)
+        assert [i[:2] for i in store.get_imports()] == [(second, "day2"), (first, "day1")]
+
+        assert [(r["Name"], r["Lineitem name"]) for r in store.get_orders(vendor="Zhen")] == [
+            ("#1001", "shirt"), ("#1002", "shirt"), ("#1004", "hat")], "#1002 is replaced by its later import"
+        assert store.get_orders(vendor="Zhen")[0] == export_orders_data()[0]
+        assert [r["Name"] for r in store.get_orders(since=datetime.date(2018, 2, 15))] == ["#1004"]
+        assert len(store.get_products()) == 3
+        assert [r["Product link"] for r in store.get_products() if r["Lineitem name"] == "shirt"] == ["http://b/shirt"]
+
+        plan = store.connection.execute("EXPLAIN QUERY PLAN SELECT data FROM orders WHERE vendor = ?", ("Zhen",))
+        assert "orders_vendor_lineitem" in " ".join(str(row) for row in plan)
+
+
+def test_run_store_reports(tmp_dir, reports_dir):
+    import pytest
+    import unicodecsv as csv
+    from supplier_reports import conf as g
+    from supplier_reports import gen_reports
+    g.config.root.order_store_path = os.path.join(tmp_dir, "orders.sqlite")
+    with pytest.raises(IOError):
+        supplier_reports.run_store_reports()
+    reports = [r for r in gen_reports.gen_reports(create_orders_export(os.path.join(tmp_dir, "day1.xlsx")))
+               if r is not None]
+
+    saved = supplier_reports.run_store_reports(vendor="Zhen")
+    assert saved == ["store-Zhen.csv"]
+    with open(os.path.join(reports_dir, "store-Zhen.csv"), "rb") as fo:
+        assert fo.read() == [r for r in reports if r.schema["match_row_value"] == "Zhen"][0].file.getvalue()
+    assert supplier_reports.run_store_reports(since_days=1) == []
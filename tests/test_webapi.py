@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import time
+import pytest
+from supplier_reports.webapi import app as webapi
+
+
+@pytest.fixture
+def client(reports_dir):
+    webapi.app.testing = True
+    webapi.app.config["JOBS_ENABLED"] = True
+    webapi.app.config["PROFILING_ENABLED"] = False
+    return webapi.app.test_client()
+
+
+def upload(client, file_path, url="/"):
+    with open(file_path, "rb") as fo:
+        return client.post(url, data={"file": (fo, os.path.basename(file_path))},
+                           content_type="multipart/form-data")
+
+
+def get_upload_path(rv):
+    """ uploads/<upload_id> of an upload response, from its zip link """
+    upload_path, = re.findall(r'href="/(uploads/[^"/]+)/reports.zip"', rv.data.decode())
+    return upload_path
+
+
+def test_upload(client, reports_dir, orders_export_file):
+    rv = upload(client, orders_export_file)
+    assert rv.status_code == 200
+    upload_path = get_upload_path(rv)
+    assert "/reports/{}/orders_export-Zhen.csv".format(upload_path) in rv.data.decode()
+    upload_dir = os.path.join(reports_dir, upload_path)
+    assert os.path.isfile(os.path.join(upload_dir, "orders_export.xlsx"))
+    assert not [f for f in os.listdir(upload_dir) if f.endswith(".tmp")]
+
+
+def test_uploads_are_namespaced(client, reports_dir, orders_export_file):
+    from supplier_reports import report_store
+    first = get_upload_path(upload(client, orders_export_file))
+    webapi.report_cache.clear(reports_dir)
+    second = get_upload_path(upload(client, orders_export_file))
+    assert first != second
+    for upload_path in (first, second):
+        manifest = report_store.read_manifest(reports_dir, upload_path.split("/")[1])
+        assert sorted(manifest["report_file_names"]) == ["orders_export-Mr_Art_Painting_store.csv",
+                                                         "orders_export-Zhen.csv"]
+    latest = report_store.get_latest_manifest(reports_dir)
+    assert latest == report_store.get_latest_manifest(reports_dir, "orders_export")
+    assert latest["upload_id"] == second.split("/")[1]
+    rv = client.get("/uploads/latest?source=orders_export")
+    assert rv.status_code == 200 and second in rv.data.decode()
+    assert client.get("/uploads/latest?source=unknown").status_code == 404
+
+
+def test_prune_uploads(reports_dir):
+    from supplier_reports import report_store
+    for upload_id, source_name in (("a1", "a"), ("a2", "a"), ("a3", "a"), ("b1", "b")):
+        report_store.create_upload_dir(reports_dir, upload_id)
+        report_store.complete_upload(reports_dir, upload_id, source_name, [])
+    for upload_id in ("abandoned", "generating"):
+        report_store.create_upload_dir(reports_dir, upload_id)
+    old = time.time() - report_store.INCOMPLETE_UPLOAD_MAX_AGE - 1
+    os.utime(report_store.get_upload_dir(reports_dir, "abandoned"), (old, old))
+    assert sorted(report_store.prune_uploads(reports_dir, 2)) == ["a1", "abandoned"]
+    assert report_store.prune_uploads(reports_dir, 0) == ["a2"], "the latest uploads are kept"
+    assert sorted(os.listdir(os.path.join(reports_dir, "uploads"))) == [
+        "a3", "b1", "generating", "latest-a.json", "latest-b.json", "latest.json"]
+
+
+def test_upload_prunes_uploads(client, reports_dir, orders_export_file):
+    from supplier_reports import conf as g
+    g.config.root.uploads_kept_per_source = 1
+    first = get_upload_path(upload(client, orders_export_file))
+    webapi.report_cache.clear(reports_dir)
+    second = get_upload_path(upload(client, orders_export_file))
+    assert not os.path.exists(os.path.join(reports_dir, first))
+    assert os.path.isdir(os.path.join(reports_dir, second))
+
+
+def test_serve_is_production(monkeypatch):
+    import werkzeug.serving
+    from werkzeug.debug import DebuggedApplication
+    calls = []
+    monkeypatch.setattr(werkzeug.serving, "run_simple", lambda *args, **kwargs: calls.append((args, kwargs)))
+    webapi.serve(host="127.0.0.1", port=8998, processes=4)
+    (args, kwargs), = calls
+    assert args == ("127.0.0.1", 8998, webapi.app)
+    assert kwargs["processes"] == 4 and not kwargs["threaded"]
+    assert not webapi.app.config["JOBS_ENABLED"], "jobs are kept in the memory of one process"
+    webapi.serve(host="127.0.0.1", port=8998, processes=1)
+    assert calls[-1][1]["threaded"] and webapi.app.config["JOBS_ENABLED"]
+    assert not kwargs["use_debugger"] and not webapi.app.debug
+    assert not webapi.app.config["PROFILING_ENABLED"]
+    assert not isinstance(webapi.app.wsgi_app, DebuggedApplication)
+
+
+def test_send_reports_caching(client, reports_dir, orders_export_file):
+    import gzip, io
+    upload_path = get_upload_path(upload(client, orders_export_file))
+    url = "/reports/{}/orders_export-Zhen.csv".format(upload_path)
+    with open(os.path.join(reports_dir, upload_path, "orders_export-Zhen.csv"), "rb") as fo:
+        content = fo.read()
+
+    rv = client.get(url)
+    assert rv.data == content and rv.content_encoding is None
+    assert rv.headers["ETag"] and rv.headers["Last-Modified"]
+    assert rv.cache_control.max_age == 0 and "Accept-Encoding" in rv.vary
+
+    assert client.get(url, headers={"If-None-Match": rv.headers["ETag"]}).status_code == 304
+
+    rv = client.get(url, headers={"Range": "bytes=0-3"})
+    assert rv.status_code == 206 and rv.data == content[:4]
+
+    rv = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert rv.content_encoding == "gzip" and rv.mimetype == "text/csv"
+    assert gzip.GzipFile(fileobj=io.BytesIO(rv.data)).read() == content
+    assert client.get(url, headers={"Accept-Encoding": "gzip", "If-None-Match": rv.headers["ETag"]}).status_code == 304
+
+
+def test_upload_rejects_missing_sheet(client, reports_dir, tmp_dir):
+    from tests.conftest import create_workbook, export_orders_data
+    file_path = create_workbook(os.path.join(tmp_dir, "no_products.xlsx"), [("Export orders", export_orders_data())])
+    rv = upload(client, file_path)
+    assert rv.status_code == 400 and b"Product list" in rv.data
+    assert os.listdir(reports_dir) == [], "part file and upload should not be kept"
+
+
+def test_upload_csv_bundle(client, reports_dir, tmp_dir):
+    from tests.conftest import create_csv_bundle, export_orders_data, product_list_data
+    file_path = create_csv_bundle(os.path.join(tmp_dir, "orders_export.zip"),
+                                  [("Export orders", export_orders_data()), ("Product list", product_list_data())])
+    rv = upload(client, file_path)
+    assert rv.status_code == 200
+    upload_dir = os.path.join(reports_dir, get_upload_path(rv))
+    assert os.path.isfile(os.path.join(upload_dir, "orders_export-Zhen.csv"))
+    assert os.path.isfile(os.path.join(upload_dir, "orders_export.zip"))
+
+
+def test_upload_size_limit(client, reports_dir, orders_export_file):
+    from supplier_reports import conf as g
+    g.config.root.max_upload_size = 1024
+    rv = upload(client, orders_export_file)
+    assert rv.status_code == 413
+    assert os.listdir(reports_dir) == []
+
+
+def test_upload_resource_limit(client, reports_dir, orders_export_file):
+    from supplier_reports import conf as g
+    g.config.root.max_source_rows = 2
+    rv = upload(client, orders_export_file)
+    assert rv.status_code == 413 and b"split the export" in rv.data
+    uploads_dir = os.path.join(reports_dir, "uploads")
+    assert not [f for f in os.listdir(uploads_dir) if os.path.isdir(os.path.join(uploads_dir, f))]
+
+
+def test_upload_job(client, reports_dir, orders_export_file):
+    import json
+    rv = upload(client, orders_export_file, url="/jobs")
+    assert rv.status_code == 202
+    job = json.loads(rv.data.decode())
+    rv = client.get(job["events"])
+    assert rv.mimetype == "text/event-stream" and rv.headers["Cache-Control"] == "no-cache"
+    events = [dict(line.split(": ", 1) for line in block.split("\n"))
+              for block in rv.data.decode().split("\n\n") if block and not block.startswith(":")]
+    assert [int(event["id"]) for event in events] == list(range(len(events)))
+    progress = [json.loads(event["data"]) for event in events if event["event"] == "progress"]
+    stages = [data["stage"] for data in progress]
+    assert "reading 'Export orders'" in stages and "validating 'data schema export_orders'" in stages
+    assert "exporting 'Zhen'" in stages
+    read = [data for data in progress if data["stage"] == "reading 'Export orders'"]
+    assert read[0]["rows"] == 0 and read[-1]["rows"] == read[-1]["total"] > 0
+    assert events[-1]["event"] == "done"
+    html = json.loads(events[-1]["data"])["html"]
+    upload_dir = os.path.join(reports_dir, re.findall(r'href="/(uploads/[^"/]+)/reports.zip"', html)[0])
+    assert os.path.isfile(os.path.join(upload_dir, "orders_export.xlsx"))
+    assert not [f for f in os.listdir(reports_dir) if ".part" in f]
+
+    # a reconnecting client resumes after its last event
+    rv = client.get(job["events"], headers={"Last-Event-ID": str(len(events) - 2)})
+    assert rv.data.decode().startswith("id: {}\nevent: done\n".format(len(events) - 1))
+
+    webapi.app.config["JOBS_ENABLED"] = False
+    assert upload(client, orders_export_file, url="/jobs").status_code == 501
+
+
+def test_upload_page_jobs(client):
+    assert b"/jobs" in client.get("/").data
+    # without jobs the form is posted once, not first to /jobs and then again
+    webapi.app.config["JOBS_ENABLED"] = False
+    rv = client.get("/")
+    assert rv.status_code == 200 and b"<form" in rv.data and b"/jobs" not in rv.data
+
+
+def test_upload_profile(client, reports_dir, orders_export_file):
+    rv = upload(client, orders_export_file, url="/?profile=1")
+    assert b".prof" not in rv.data, "profiling is only enabled on the development server"
+    webapi.app.config["PROFILING_ENABLED"] = True
+    rv = upload(client, orders_export_file, url="/?profile=1")
+    upload_path = get_upload_path(rv)
+    assert [f for f in os.listdir(os.path.join(reports_dir, upload_path)) if f.endswith(".prof")]
+    assert b".prof" in rv.data, "a profiled upload is never served from the report cache"
+
+
+def test_upload_job_failed(client, reports_dir, tmp_dir):
+    import json
+    from tests.conftest import create_workbook, export_orders_data
+    file_path = create_workbook(os.path.join(tmp_dir, "no_products.xlsx"), [("Export orders", export_orders_data())])
+    job = json.loads(upload(client, file_path, url="/jobs").data.decode())
+    data = client.get(job["events"]).data.decode()
+    assert "event: failed" in data and "Product list" in data
+    assert not [f for f in os.listdir(reports_dir) if ".part" in f]
+    assert client.get("/jobs/unknown/events").status_code == 404
+
+
+def test_upload_report_cache(client, reports_dir, orders_export_file, monkeypatch):
+    first = upload(client, orders_export_file)
+    upload_path = get_upload_path(first)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("identical upload should be served from the cache")
+    monkeypatch.setattr(webapi, "gen_reports", fail)
+    second = upload(client, orders_export_file)
+    assert second.status_code == 200 and second.data == first.data
+
+    # a report changed since it was cached is a miss
+    with open(os.path.join(reports_dir, upload_path, "orders_export-Zhen.csv"), "a") as fo:
+        fo.write("changed")
+    assert b"identical upload should be served from the cache" in upload(client, orders_export_file).data
+
+
+def test_upload_report_cache_catalogue(client, reports_dir, tmp_dir, orders_export_file):
+    from supplier_reports import conf as g
+    from supplier_reports.gen_reports import import_product_catalogue
+    from tests.conftest import create_orders_export, product_list_data
+    g.config.root.lookup_backend = "disk"
+    g.config.root.product_lookup_path = os.path.join(tmp_dir, "products.lookup")
+    import_product_catalogue(orders_export_file)
+    assert b"http://a/shirt" in client.get("/reports/{}/orders_export-Zhen.csv".format(
+        get_upload_path(upload(client, orders_export_file)))).data
+
+    # a new catalogue is a cache miss
+    products = product_list_data()
+    products[0]["Product link"] = "http://new/shirt"
+    import_product_catalogue(create_orders_export(os.path.join(tmp_dir, "catalogue.xlsx"), products=products))
+    assert b"http://new/shirt" in client.get("/reports/{}/orders_export-Zhen.csv".format(
+        get_upload_path(upload(client, orders_export_file)))).data
+
+
+def test_report_cache_eviction(tmp_dir):
+    from supplier_reports.webapi.report_cache import ReportCache
+    for name, size in (("a", 10), ("b", 10), ("c", 30)):
+        with open(os.path.join(tmp_dir, name), "w") as fo:
+            fo.write("x" * size)
+    cache = ReportCache(max_entries=2, max_bytes=40)
+    cache.put("1", tmp_dir, ["a"])
+    cache.put("2", tmp_dir, ["b"])
+    assert cache.get("1", tmp_dir) == ["a"]
+    cache.put("3", tmp_dir, ["c"])
+    assert cache.get("2", tmp_dir) is None, "least recently used entry is evicted"
+    assert cache.get("1", tmp_dir) == ["a"] and cache.get("3", tmp_dir) == ["c"]
+    cache.put("4", tmp_dir, ["c"])
+    assert cache.get_entries(tmp_dir) == ["4"], "evicted by max_entries and then to fit max_bytes"
+
+
+def test_report_cache_eviction_removes_uploads(client, reports_dir, tmp_dir, orders_export_file, monkeypatch):
+    from tests.conftest import create_orders_export, product_list_data
+    monkeypatch.setattr(webapi.report_cache, "max_entries", 1)
+    first = get_upload_path(upload(client, orders_export_file))
+    products = product_list_data()
+    products[0]["Product link"] = "http://new/shirt"
+    os.mkdir(os.path.join(tmp_dir, "new"))
+    changed_file = create_orders_export(os.path.join(tmp_dir, "new", "orders_export.xlsx"), products=products)
+    second = get_upload_path(upload(client, changed_file))
+    assert not os.path.exists(os.path.join(reports_dir, first)), "evicted upload is removed"
+
+    # the latest upload of a source is kept when evicted
+    other_file = create_orders_export(os.path.join(tmp_dir, "other_export.xlsx"))
+    third = get_upload_path(upload(client, other_file))
+    assert os.path.isdir(os.path.join(reports_dir, second)) and os.path.isdir(os.path.join(reports_dir, third))
+
+
+def test_report_cache_is_shared(tmp_dir):
+    import multiprocessing
+    from supplier_reports.webapi.report_cache import ReportCache
+    with open(os.path.join(tmp_dir, "a"), "w") as fo:
+        fo.write("x")
+    # a forked server process puts, the parent and any other process get
+    process = multiprocessing.Process(target=ReportCache(2, 40).put, args=("1", tmp_dir, ["a"]))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    assert ReportCache(2, 40).get("1", tmp_dir) == ["a"]
+
+
+def test_send_reports_zip(client, reports_dir, orders_export_file):
+    import io, zipfile
+    upload_path = get_upload_path(upload(client, orders_export_file))
+    rv = client.get("/{}/reports.zip".format(upload_path))
+    assert rv.status_code == 200 and rv.mimetype == "application/zip" and rv.is_streamed
+    assert "orders_export.zip" in rv.headers["Content-Disposition"]
+    archive = zipfile.ZipFile(io.BytesIO(rv.data))
+    assert archive.testzip() is None
+    assert sorted(archive.namelist()) == ["orders_export-Mr_Art_Painting_store.csv", "orders_export-Zhen.csv"]
+    with open(os.path.join(reports_dir, upload_path, "orders_export-Zhen.csv"), "rb") as fo:
+        assert archive.read("orders_export-Zhen.csv") == fo.read()
+
+    assert client.get("/uploads/unknown/reports.zip").status_code == 404
+
+
+def test_view_report_pages(client, reports_dir, tmp_dir):
+    from supplier_reports import conf as g
+    from tests.conftest import create_orders_export, export_orders_data, order_row
+    orders = [order_row("#{}".format(2000 + i), "Zhen", "shirt") for i in range(25)]
+    file_path = create_orders_export(os.path.join(tmp_dir, "big.xlsx"), orders=orders)
+    g.config.root.viewer_page_size = 10
+    rv = upload(client, file_path)
+    url = "/view/{}/big-Zhen.csv".format(get_upload_path(rv))
+    assert 'href="{}"'.format(url) in rv.data.decode()
+
+    rv = client.get(url)
+    assert rv.status_code == 200
+    assert b"#2000" in rv.data and b"#2009" in rv.data and b"#2010" not in rv.data
+    assert b"page 1 of 3" in rv.data and b"?page=2" in rv.data
+
+    rv = client.get(url + "?page=3")
+    assert b"#2020" in rv.data and b"#2024" in rv.data and b"#2019" not in rv.data
+    assert b"page 3 of 3" in rv.data and b"<th>Lineitem name</th>" in rv.data
+
+    assert client.get("/view/missing.csv").status_code == 404